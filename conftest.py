@@ -0,0 +1,7 @@
+import sys
+
+# machinerry_async (and its tests) use syntax which is only available
+# from Python 3.7 onwards.
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore += ['machinerry_async.py', 'tests/test_machinerry_async.py']
@@ -1,37 +1,632 @@
-import cherrypy
+import atexit
+import collections
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import signal
+import stat
+import sys
 import threading
+import time
 
+from traceback import format_stack
 
 import datetime
+import zlib
 _utcnow = datetime.datetime.utcnow
 
+try:
+    from concurrent import futures
+except ImportError:  # Python 2 without the futures backport.
+    futures = None
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:  # Python 2 (the futures backport doesn't have it).
+    class BrokenProcessPool(Exception):
+        pass
+
+try:
+    import queue
+except ImportError:  # Python 2.
+    import Queue as queue
+
+try:
+    _get_ident = threading.get_ident
+except AttributeError:
+    # noinspection PyProtectedMember
+    # This is for Python 2 compatibility.
+    _get_ident = threading._get_ident  # pylint: disable=no-member
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+# The process pool shared by machines which perform work in other
+# processes - see get_process_pool.
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """Returns the process pool shared between all machines, creating
+    a ProcessPoolExecutor with the default number of workers if one
+    hasn't been set with set_process_pool."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = futures.ProcessPoolExecutor()
+            atexit.register(_discard_process_pool, _process_pool)
+        return _process_pool
+
+
+def set_process_pool(pool):
+    """Sets the executor to be shared between all machines for work
+    performed in other processes. This should be done before any
+    machines start, if you want to control the number of workers."""
+    global _process_pool
+    with _process_pool_lock:
+        _process_pool = pool
+
+
+def _discard_process_pool(pool):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False)
+
+
+# CherryPy isn't imported until a machine is used with it (see
+# Machine.subscribe), so that machines can be run without it (see
+# run_machines). Until then, we log through the standard logging module.
+_logger = logging.getLogger('machinerry')
+
+
+def _cherrypy_log():
+    cherrypy = sys.modules.get('cherrypy')
+    return None if cherrypy is None else cherrypy.log
+
+
+# Set by enable_queued_logging - the handler which puts log records on
+# the queue, and the listener which writes them from a background thread.
+_log_handler = None
+_log_listener = None
+_log_lock = threading.Lock()
+
+
+# Used by the log listener to pass records on to cherrypy.log (or the
+# machinerry logger if CherryPy isn't being used).
+class _LogWriter(logging.Handler):
+
+    def emit(self, record):
+        cplog = _cherrypy_log()
+        if cplog is None:
+            _logger.handle(record)
+            return
+        msg = record.getMessage()
+        if record.exc_info:
+            tb = logging.Formatter().formatException(record.exc_info)
+            msg = msg + '\n' + tb if msg else tb
+        cplog(msg, severity=record.levelno)
+
+
+def enable_queued_logging():
+    """Makes machines put their log messages on a queue, which is written
+    to cherrypy.log by a background thread shared between all machines -
+    so that a slow log handler doesn't hold up the machines.
+
+    Messages are only formatted by the background thread, and aren't
+    queued at all if cherrypy.log wouldn't log them at that level.
+
+    If CherryPy hasn't been imported, messages are written to the
+    machinerry logger instead."""
+    global _log_handler, _log_listener
+    try:
+        from logging.handlers import QueueHandler, QueueListener
+    except ImportError:  # Python 2.
+        raise RuntimeError('queued logging requires Python 3.2 or later')
+    with _log_lock:
+        if _log_listener is None:
+            log_queue = queue.Queue()
+            _log_listener = QueueListener(log_queue, _LogWriter())
+            _log_listener.start()
+            _log_handler = QueueHandler(log_queue)
+
+
+def disable_queued_logging():
+    """Stops queueing log messages (see enable_queued_logging), after
+    waiting for any queued messages to be written."""
+    global _log_handler, _log_listener
+    with _log_lock:
+        listener = _log_listener
+        _log_handler = _log_listener = None
+    if listener is not None:
+        listener.stop()
+
+
+# Logs a message via cherrypy.log (or the queue if enable_queued_logging
+# has been called, or the machinerry logger if CherryPy isn't in use).
+# The message is formatted with args in the same way as the logging
+# module, and the severity and traceback keyword arguments behave as they
+# do for cherrypy.log - except that tracebacks are logged as errors by
+# default, so they aren't lost when the machinerry logger isn't set up to
+# show informational messages (such as under run_machines).
+def _log(msg, *args, **kwargs):
+    traceback = kwargs.pop('traceback', False)
+    severity = kwargs.pop(
+        'severity', logging.ERROR if traceback else logging.INFO)
+
+    cplog = _cherrypy_log()
+    handler = _log_handler
+    if handler is None:
+        if cplog is None:
+            _logger.log(severity, msg, *args, exc_info=traceback)
+        else:
+            cplog(msg % args if args else msg, severity=severity,
+                  traceback=traceback)
+        return
+
+    logger = _logger if cplog is None else cplog.error_log
+    if not logger.isEnabledFor(severity):
+        return
+    exc_info = sys.exc_info() if traceback else None
+    handler.enqueue(logging.LogRecord(
+        'machinerry', severity, __file__, 0, msg, args, exc_info))
+
+
+# Describes something which has happened to a machine - see
+# BoneMachine.add_observer.
+MachineEvent = collections.namedtuple('MachineEvent', [
+    'kind', 'machine', 'run', 'error',
+])
+
+
+# An observer registered with BoneMachine.add_observer. Events waiting to
+# be delivered to it are kept in a bounded buffer - if the observer falls
+# too far behind, the oldest ones are discarded (and counted in dropped).
+class _Observer(object):
+
+    KINDS = frozenset(['run', 'error', 'pause', 'resume', 'fail'])
+    BUFFER_SIZE = 1000
+
+    def __init__(self, target, kinds, overflow):
+        if overflow not in ('drop-oldest', 'block'):
+            raise ValueError('unknown overflow policy: %r' % overflow)
+        if isinstance(kinds, (str, type(u''))):
+            kinds = [kinds]
+        self.kinds = None if kinds is None else frozenset(kinds)
+        if self.kinds is not None and not self.kinds <= self.KINDS:
+            raise ValueError('unknown kinds of event: %s' % ', '.join(
+                sorted(self.kinds - self.KINDS)))
+        self.target = target
+        self.overflow = overflow
+        self.is_queue = not callable(target)
+        self.dropped = 0
+        self.closed = False
+
+        # These are managed by _ObserverDispatcher - scheduled is set
+        # while the dispatcher has events to deliver to us.
+        self.buffer = collections.deque()
+        self.scheduled = False
+
+    def publish(self, event):
+        if self.kinds is None or event.kind in self.kinds:
+            _observer_dispatcher.publish(self, event)
+
+    # Stops accepting events - those already buffered are still delivered.
+    def close(self):
+        self.closed = True
+
+    # Returns False if the event couldn't be delivered yet, because we
+    # are a full queue with the 'block' overflow policy.
+    def deliver(self, event):
+        if not self.is_queue:
+            self.target(event)
+        elif self.overflow == 'block':
+            try:
+                self.target.put_nowait(event)
+            except queue.Full:
+                return False
+        else:
+            while True:
+                try:
+                    self.target.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        self.target.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        return True
+
+
+# Delivers events to observers from a small pool of threads shared by all
+# machines, so machines never have to wait for their observers. Each
+# observer is only handled by one thread at a time (so its events arrive
+# in order), and gets one event delivered before the next observer has a
+# turn. An observer waiting for room in a full queue is set aside and
+# retried every RETRY_INTERVAL seconds, rather than tying up a thread.
+class _ObserverDispatcher(object):
+
+    THREADS = 4
+    RETRY_INTERVAL = 0.05
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._ready = collections.deque()
+        self._parked = []  # Heap of (retry time, sequence, observer).
+        self._sequence = itertools.count()
+        self._threads = []
+        self._idle = 0
+
+    def publish(self, observer, event):
+        with self._lock:
+            if observer.closed:
+                return
+            self._buffer(observer, event)
+            if observer.scheduled:
+                return
+            observer.scheduled = True
+            self._ready.append(observer)
+            if not self._idle and len(self._threads) < self.THREADS:
+                thread = threading.Thread(target=self._dispatch)
+                thread.name = 'machinerry observer'
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            self._lock.notify()
+
+    # Adds an event to the observer's buffer, discarding the oldest one if
+    # it is full. Must be called with the lock held.
+    @staticmethod
+    def _buffer(observer, event, oldest=False):
+        buffer = observer.buffer
+        if oldest:
+            buffer.appendleft(event)
+        else:
+            buffer.append(event)
+        if len(buffer) > observer.BUFFER_SIZE:
+            buffer.popleft()
+            observer.dropped += 1
+
+    # Waits for an observer with events ready to be delivered. Must be
+    # called with the lock held.
+    def _next_observer(self):
+        while True:
+            now = _monotonic()
+            parked = self._parked
+            while parked and parked[0][0] <= now:
+                self._ready.append(heapq.heappop(parked)[2])
+            if self._ready:
+                return self._ready.popleft()
+            self._idle += 1
+            try:
+                self._lock.wait(parked[0][0] - now if parked else None)
+            finally:
+                self._idle -= 1
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                observer = self._next_observer()
+                event = observer.buffer.popleft()
+
+            # noinspection PyBroadException
+            try:
+                delivered = observer.deliver(event)
+            except Exception:  # pylint: disable=broad-except
+                _log('', traceback=True)
+                delivered = True
+
+            with self._lock:
+                if not delivered:
+                    self._buffer(observer, event, oldest=True)
+                    heapq.heappush(self._parked, (
+                        _monotonic() + self.RETRY_INTERVAL,
+                        next(self._sequence), observer))
+                elif observer.buffer:
+                    self._ready.append(observer)
+                else:
+                    observer.scheduled = False
+
+
+_observer_dispatcher = _ObserverDispatcher()
+
+
+class RunCancelled(Exception):
+
+    """Raised by CancellationToken.raise_if_cancelled to abandon a run
+    which has been cancelled. When execute raises this, the run is not
+    treated as having failed."""
+
+
+class CancellationToken(object):
+
+    """Used to tell a run in progress that it should finish early - each
+    run object has one (as its token attribute).
+
+    The token is cancelled when the machine is asked to stop or pause,
+    or when the run has taken longer than the machine's run_timeout.
+    The execute method can check the cancelled attribute, or use wait
+    instead of time.sleep, and then return early or call
+    raise_if_cancelled. Either way, the run will be recorded as being
+    cancelled."""
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self.deadline = None if timeout is None else _monotonic() + timeout
+
+        # Why the token was cancelled - 'stop', 'pause' or 'timeout' (or
+        # whatever was passed to cancel).
+        self.reason = None
+
+        # Set once the run has been told that it has been cancelled.
+        self._observed = False
+
+    @property
+    def cancelled(self):
+        """Whether the run has been cancelled."""
+        if not self._event.is_set() and self.deadline is not None \
+                and _monotonic() >= self.deadline:
+            self.cancel('timeout')
+        if self._event.is_set():
+            self._observed = True
+            return True
+        return False
+
+    def cancel(self, reason=None):
+        """Cancels the run (if it hasn't already been cancelled)."""
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def wait(self, timeout=None):
+        """Sleeps for up to timeout seconds, waking up early if the run is
+        cancelled. Returns True if the run has been cancelled."""
+        if self.deadline is not None:
+            remaining = max(self.deadline - _monotonic(), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        self._event.wait(timeout)
+        return self.cancelled
+
+    def raise_if_cancelled(self):
+        """Raises RunCancelled if the run has been cancelled."""
+        if self.cancelled:
+            raise RunCancelled(self.reason)
+
+
+# Watches the runs of all machines which have a run_timeout, and tells
+# the machine when one has gone on for too long. This uses a single
+# thread (which is only started when it's needed) for all machines.
+class _Watchdog(object):
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+        # The heap entry for each run being watched, by the run's id.
+        self._entries = {}
+
+    def watch(self, machine, run):
+        entry = [run.token.deadline, next(self._counter), machine, run]
+        with self._cond:
+            self._entries[id(run)] = entry
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.name = 'machinerry watchdog'
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    # Stops watching a run which has finished. Its entry is left in the
+    # heap until it reaches the top (without holding on to the machine or
+    # the run) - but if runs finish quickly, we don't want them
+    # accumulating.
+    def unwatch(self, run):
+        with self._cond:
+            entry = self._entries.pop(id(run), None)
+            if entry is None:
+                return
+            entry[2] = entry[3] = None
+            if len(self._heap) > 2 * len(self._entries) + 16:
+                self._heap = [i for i in self._heap if i[3] is not None]
+                heapq.heapify(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, _, machine, run = self._heap[0]
+                delay = deadline - _monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if run is None:
+                    continue
+                del self._entries[id(run)]
+
+            if run in machine.machine_runs_in_flight:
+                machine._run_overran(run)
+
+
+_watchdog = _Watchdog()
+
 
 # Simple namespace to store run-specific information.
+#
+# The standard attributes are stored in slots to keep each record small,
+# but any other attributes can be set on it too (the dictionary to hold
+# them only gets created when that happens).
+
 
+class Run(object):
 
-class Run(dict):
+    __slots__ = (
+        'id', 'time_start', 'time_end', 'time_next', 'time_planned', 'lag',
+        'jitter', 'failed', 'cancelled', 'token', 'overrun', 'overrun_stack',
+        'thread_id', 'pause_flag_set', '_paused_by_execute', '__dict__',
+    )
 
     def __init__(self):
+        self.id = None
         self.time_start = None
         self.time_end = None
         self.time_next = None
+        self.time_planned = None
+        self.lag = None
+
+        # How many seconds of wait_jitter were added to time_planned.
+        self.jitter = 0.0
         self.failed = False
+        self.cancelled = False
+        self.token = None
+
+        # Set if the run took longer than run_timeout, along with the
+        # stack of the thread performing it at that point.
+        self.overrun = False
+        self.overrun_stack = None
+
+        # The identifier of the thread performing the run.
+        self.thread_id = None
         self.pause_flag_set = False
 
-    def __getattr__(self, attr):
-        try:
-            return self[attr]
-        except KeyError:
-            raise AttributeError(attr)
+        # Only set while the run is in the execute block.
+        self._paused_by_execute = None
 
-    def __setattr__(self, attr, val):
-        self[attr] = val
+    def __repr__(self):
+        return '<Run %s started at %s>' % (self.id, self.time_start)
 
-    def __delattr__(self, attr):
-        try:
-            del self[attr]
-        except KeyError:
-            raise AttributeError(attr)
+
+class RunStats(object):
+
+    """Running totals describing the runs performed by a machine.
+
+    These are updated at a fixed cost as each run finishes, regardless
+    of how many runs have taken place - durations are counted in a
+    histogram of fixed size, which is used to estimate percentiles."""
+
+    # Durations are counted in buckets on a logarithmic scale, starting
+    # from a millisecond and with four buckets for each doubling (which
+    # goes up to around three days). Percentiles calculated from these
+    # are accurate to within 19%.
+    BUCKET_BASE = 0.001
+    BUCKETS_PER_DOUBLING = 4
+    BUCKET_COUNT = 112
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        self.buckets = [0] * self.BUCKET_COUNT
+
+    @classmethod
+    def bucket_bound(cls, index):
+        """The upper bound (in seconds) of the durations counted in the
+        bucket with the given index."""
+        return cls.BUCKET_BASE * 2 ** (float(index) / cls.BUCKETS_PER_DOUBLING)
+
+    @classmethod
+    def bucket_index(cls, duration):
+        """The index of the bucket which the duration is counted in."""
+        if duration <= cls.BUCKET_BASE:
+            return 0
+        index = math.ceil(
+            math.log(duration / cls.BUCKET_BASE, 2) * cls.BUCKETS_PER_DOUBLING)
+        return min(int(index), cls.BUCKET_COUNT - 1)
+
+    def record(self, duration, failed=False):
+        """Records a run which took the given number of seconds."""
+        self.count += 1
+        if failed:
+            self.failures += 1
+        self.duration_total += duration
+        if duration > self.duration_max:
+            self.duration_max = duration
+        self.buckets[self.bucket_index(duration)] += 1
+
+    def percentile(self, pct):
+        """Returns an estimate of the given percentile of run durations
+        (or None if there haven't been any runs)."""
+        if not self.count:
+            return None
+        target = self.count * pct / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_bound(index), self.duration_max)
+        return self.duration_max
+
+    def merge(self, other):
+        """Adds the runs recorded by another RunStats object to these
+        ones (for describing several machines together)."""
+        self.count += other.count
+        self.failures += other.failures
+        self.duration_total += other.duration_total
+        self.duration_max = max(self.duration_max, other.duration_max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def as_dict(self):
+        """Returns the statistics as a dictionary (as used by
+        Machine.status)."""
+        count = self.count
+        return dict(
+            count=count,
+            failures=self.failures,
+            failure_rate=float(self.failures) / count if count else None,
+            mean=self.duration_total / count if count else None,
+            max=self.duration_max if count else None,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+        )
+
+
+# An immutable record of the state of a machine, which gets replaced
+# whenever the state changes - see BoneMachine.machine_snapshot.
+MachineSnapshot = collections.namedtuple('MachineSnapshot', [
+    'generation', 'state', 'time_start', 'time_end', 'time_next', 'up_since',
+])
+
+
+class RollingStats(object):
+
+    """Keeps the most recent values of a measurement (such as how late
+    runs have been starting), to describe how it has behaved recently."""
+
+    def __init__(self, size=100):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        """Records a new value of the measurement."""
+        self.samples.append(value)
+        self.count += 1
+
+    def as_dict(self):
+        """Returns a dictionary with the total number of values recorded,
+        and the last, mean and maximum of the recent values."""
+        samples = list(self.samples)
+        if not samples:
+            return dict(count=self.count, last=None, mean=None, max=None)
+        return dict(
+            count=self.count,
+            last=samples[-1],
+            mean=sum(samples) / len(samples),
+            max=max(samples),
+        )
 
 
 class BoneMachine(object):
@@ -47,6 +642,7 @@ class BoneMachine(object):
     STOPPING = 'STOPPING'
     STOPPED = 'STOPPED'
     FAILED = 'FAILED'
+    STANDBY = 'STANDBY'
 
     # How long to wait for before executing the next run if an error
     # occurs. If set, then this is used regardless of whether
@@ -61,6 +657,35 @@ class BoneMachine(object):
     # run.
     wait_run_frequency = None
 
+    # What to do when runs performed at wait_run_frequency fall behind
+    # schedule (because a run took too long, or the machine was busy):
+    #   'coalesce' - perform a single run to make up for all the missed
+    #                ones, and then carry on with the schedule.
+    #   'skip'     - don't make up for missed runs, and wait for the
+    #                next time on the schedule.
+    #   'burst'    - perform all the missed runs back to back until we
+    #                have caught up.
+    wait_catch_up = 'coalesce'
+
+    # If set, a random delay of up to this many seconds is added to the
+    # time of each run when it is scheduled, so that machines which run
+    # at the same frequency don't all hit shared resources at the same
+    # moment. This doesn't accumulate on runs performed at
+    # wait_run_frequency - the schedule remains anchored to its original
+    # timeline.
+    wait_jitter = None
+
+    # If set, the first run after the machine starts will be delayed by
+    # up to this many seconds, so that machines started together (such
+    # as when the engine starts) spread their first runs - and so their
+    # subsequent runs - over this window.
+    start_spread = None
+
+    # Whether the delay within start_spread is chosen at random. If not,
+    # it is derived from the machine name, so a machine will get the
+    # same offset each time it starts.
+    start_spread_random = False
+
     # You can set a specific time to wait for after a particular run.
     #
     # This will override the other wait values, and will be set to
@@ -86,12 +711,23 @@ class BoneMachine(object):
     # How many run objects have we created so far?
     _run_count = 0
 
-    # The current state of the machine execution.
-    machine_state = STOPPED
+    # Internal state value - use 'machine_state' instead.
+    _machine_state = STOPPED
+
+    # The identifier of the thread currently performing the machine's
+    # work.
+    machine_threadid = None
+
+    # The MachineScheduler to run this machine on. If None, the machine
+    # will run in a dedicated thread of its own.
+    machine_scheduler = None
 
     # When did the machine start execution?
     machine_up_since = None
 
+    # The run object of the most recently completed run.
+    machine_last_run = None
+
     # Internal pause flag - use 'paused' instead.
     _paused = False
 
@@ -112,6 +748,36 @@ class BoneMachine(object):
     # The datetime of when the machine went into pause mode.
     pause_time = None
 
+    # How many times the machine has been paused, and how many seconds
+    # it has spent paused (not including the current pause).
+    machine_pause_count = 0
+    machine_pause_seconds = 0.0
+
+    # The monotonic time of when the machine went into pause mode.
+    _machine_paused_since = None
+
+    # How many seconds a run is allowed to take before its cancellation
+    # token is cancelled (see CancellationToken). If None, runs can take
+    # as long as they like.
+    #
+    # Runs which go on for longer are also reported to the
+    # on_machine_run_overrun hook.
+    run_timeout = None
+
+    # How many runs are allowed to be in progress at the same time. If
+    # this is more than one, runs will be performed in a pool of worker
+    # threads, and the machine will start the next run when it is due
+    # even if previous runs have yet to finish (up to this limit). This
+    # should be set before the machine is started.
+    max_concurrent_runs = 1
+
+    # If set, and execute returns a callable, then that callable will be
+    # invoked in the process pool shared between machines, and what it
+    # returns (or raises) will be treated as the outcome of the run. The
+    # callable must be picklable (so a module-level function, or a
+    # functools.partial wrapping one).
+    execute_in_process = False
+
     # Flag indicating whether the machine should automatically pause
     # itself if an error occurs when invocating 'execute'.
     #
@@ -125,12 +791,14 @@ class BoneMachine(object):
     def _set_paused(self, state):
         self._paused = state
 
-        # Detect if we were changed by the machine thread, and if we
-        # were in the execute block (we can verify with the existence
-        # of the _paused_by_execute attribute on the current machine_run).
-        if threading.current_thread() is self.machine_thread and \
-                hasattr(self.machine_run, '_paused_by_execute'):
-            self.machine_run._paused_by_execute = state
+        # Detect if we were changed by the thread performing a run, and
+        # if we were in the execute block (we can verify with the
+        # _paused_by_execute attribute on the run being set).
+        run = getattr(self._machine_local, 'run', None)
+        if run is not None and run._paused_by_execute is not None:
+            run._paused_by_execute = state
+        elif state:
+            self._cancel_runs('pause')
         self.interrupt()
 
     paused = property(_get_paused, _set_paused, doc='''
@@ -140,6 +808,50 @@ class BoneMachine(object):
         as is convenient.
     ''')
 
+    def _get_machine_state(self):
+        return self._machine_state
+
+    def _set_machine_state(self, state):
+        if state != self._machine_state:
+            self._machine_state = state
+            self._publish_snapshot()
+
+    machine_state = property(_get_machine_state, _set_machine_state, doc='''
+        The current state of the machine execution.
+    ''')
+
+    # Replaces machine_snapshot with one describing the current state of
+    # the machine - this is done whenever its state or run times change.
+    #
+    # Anything waiting for the machine to change (see _wait_for) is
+    # notified at the same time.
+    def _publish_snapshot(self):
+        with self._machine_changed:
+            self.machine_snapshot = MachineSnapshot(
+                next(self._machine_generation), self._machine_state,
+                self.run_time_start, self.run_time_end, self.run_time_next,
+                self.machine_up_since,
+            )
+            self._machine_changed.notify_all()
+            if self._machine_watchers:
+                self._machine_watchers = [
+                    w for w in self._machine_watchers if not w()]
+
+    @property
+    def machine_run(self):
+        """The run object for the run currently being performed.
+
+        If more than one run is in progress, then this will be the run
+        being performed by the calling thread - or the most recently
+        started run if the calling thread isn't performing one."""
+        run = getattr(self._machine_local, 'run', None)
+        if run is None:
+            try:
+                run = self.machine_runs_in_flight[-1]
+            except IndexError:
+                pass
+        return run
+
     @property
     def machine_active(self):
         return self.machine_state in (self.RUNNING, self.WAITING)
@@ -153,112 +865,231 @@ class BoneMachine(object):
         self.machine_thread = None
         self.machine_is_running = False
         self.machine_event_flag = threading.Event()
-        self.machine_run_history = []
+        self.machine_run_history = collections.deque()
+        self.machine_runs_in_flight = []
+        self.machine_stats = RunStats()
+
+        # How late runs have started compared to when they were due, and
+        # how much longer than intended the machine has slept for when
+        # waiting for something to be due (both in seconds).
+        self.machine_start_lag = RollingStats()
+        self.machine_wakeup_lag = RollingStats()
+        self._machine_local = threading.local()
+        self._machine_lock = threading.RLock()
+        self._machine_run_pool = None
+        self._machine_deadline = (None, None)
+
+        # The run_time_next that wait_jitter was last added to, and how
+        # many seconds were added.
+        self._run_time_jitter = (None, 0.0)
+
+        # An immutable description of the machine's state, which can be
+        # read from any thread. Its generation is increased every time it
+        # is replaced, so callers can tell if anything has changed.
+        self._machine_generation = itertools.count()
+        self._machine_changed = threading.Condition()
+        self._machine_watchers = []
+
+        # This gets replaced rather than modified, so it can be handed
+        # to the event dispatcher without being copied. It has a lock of
+        # its own, so observers can be added while a run is in progress.
+        self._machine_observers = ()
+        self._machine_observers_lock = threading.Lock()
+        self._publish_snapshot()
 
     def start(self):
-        """Start processing in a new Thread."""
+        """Start processing in a new Thread (or on machine_scheduler if
+        one has been set)."""
+        if self.max_concurrent_runs > 1 and futures is None:
+            raise RuntimeError(
+                'max_concurrent_runs requires concurrent.futures')
         if self.machine_thread is None:
-            self.machine_thread = threading.Thread(target=self.run)
-            self.machine_thread.name = ("%s thread" % self.machine_name)
-            self.machine_thread.start()
+            self.machine_thread = self._launch()
+
+    # Begins running the machine, returning the thread which will be
+    # performing it (or an object which behaves like one).
+    def _launch(self):
+        if self.machine_scheduler is not None:
+            return self.machine_scheduler.schedule(self)
+        thread = threading.Thread(target=self.run)
+        thread.name = ("%s thread" % self.machine_name)
+        thread.start()
+        return thread
 
     def stop(self):
         """Stop processing."""
         self.machine_is_running = False
         self.machine_thread = None
         self.machine_state = self.STOPPING
+        self._cancel_runs('stop')
         self.interrupt()
 
+    # Cancels the tokens of any runs in progress.
+    def _cancel_runs(self, reason):
+        for run in list(self.machine_runs_in_flight):
+            run.token.cancel(reason)
+
     def now(self):
         return _utcnow()
 
     def run(self):
         """Continuously run self.execute(). Errors are trapped and logged."""
         try:
-            try:
-                get_ident = threading.get_ident
-            except AttributeError:
-                # noinspection PyProtectedMember
-                # This is for Python 2 compatibility.
-                get_ident = threading._get_ident  # pylint: disable=no-member
-            self.machine_threadid = get_ident()
-            self.machine_is_running = True
-            self.machine_up_since = self.now()
-
-            # Subclasses may choose to delay execution by setting
-            # run_time_next manually.
-            if self.run_time_next is None:
-                self.run_time_next = self.machine_up_since
+            self.machine_threadid = _get_ident()
+            self._machine_startup()
 
             while self.machine_is_running:
-                now = self.now()
                 self.machine_event_flag.clear()
+                wait = self._machine_step()
+                if wait is None or wait > 0:
+                    slept_from = _monotonic()
+                    if not self.machine_event_flag.wait(wait) and wait:
+                        self.machine_wakeup_lag.add(
+                            _monotonic() - slept_from - wait)
 
-                if self.paused:
-                    self._become_paused(True)
-                    if not self.pause_until:
-                        self.machine_event_flag.wait(self.wait_min)
-                        continue
-
-                    # We've been asked to pause until a specific time.
-                    self._wait_until(self.pause_until)
-                    now = self.now()
-
-                    # Been interrupted because we're now longer paused,
-                    # so loop again!
-                    if not self.paused:
-                        continue
-
-                    # We're still paused after the wait.
-                    if self.pause_until <= now:
-                        self.on_machine_pause_elapsed()
-                        if self.paused and self.pause_until <= now:
-                            e = 'still paused and not updating pause_until'
-                            raise AssertionError(e)
-                    continue
+            self._machine_shutdown()
 
-                # end-if self.paused block
+        except Exception as e:
+            self._machine_failed(e)
+            raise
 
-                self._become_paused(False)
+    # The methods below make up the body of the run method - they are
+    # separated out so that a MachineScheduler can drive the machine
+    # without it needing a thread of its own.
+
+    def _machine_startup(self):
+        self.machine_is_running = True
+        self.machine_up_since = self.now()
+
+        # Subclasses may choose to delay execution by setting
+        # run_time_next manually.
+        if self.run_time_next is None:
+            self.run_time_next = self.machine_up_since + \
+                datetime.timedelta(seconds=self.start_offset())
+        self._publish_snapshot()
+
+    def start_offset(self):
+        '''Returns how many seconds after starting the first run of the
+        machine should be performed (see start_spread).'''
+        if not self.start_spread:
+            return 0
+        if self.start_spread_random:
+            return random.uniform(0, self.start_spread)
+        name = self.machine_name.encode('utf-8')
+        fraction = (zlib.crc32(name) & 0xffffffff) / float(2 ** 32)
+        return fraction * self.start_spread
+
+    # Performs a single iteration of the machine loop. Returns how many
+    # seconds to wait for before the next iteration (unless we get
+    # interrupted before then), or None to wait until interrupted.
+    def _machine_step(self):
+        # Runs being performed in the worker pool will need to wait for
+        # us before they can update the state of the machine.
+        with self._machine_lock:
+            return self._machine_step_locked()
+
+    def _machine_step_locked(self):
+        wait = self._machine_poll()
+        if wait is not self._RUN_DUE:
+            return wait
+
+        self.machine_state = self.RUNNING
+        if self.max_concurrent_runs > 1:
+            return self._dispatch_run()
+        self.run_once()
+        return 0
+
+    # Returned by _machine_poll to indicate a run should be performed.
+    _RUN_DUE = object()
+
+    # Deals with everything in an iteration of the machine loop apart
+    # from actually performing a run. Returns _RUN_DUE if a run should
+    # now be performed, otherwise it returns the same as _machine_step.
+    def _machine_poll(self):
+        now = self.now()
 
-                if now < self.run_time_next:
-                    self.machine_state = self.WAITING
-                    self._wait_until(self.run_time_next)
-                    continue
+        if self.paused:
+            self._become_paused(True)
+            pause_until = self.pause_until
+            if not pause_until:
+                return self.wait_min
+
+            # We've been asked to pause until a specific time.
+            if now < pause_until:
+                return self._how_long_until(pause_until)
+
+            # We're still paused after the wait.
+            self.on_machine_pause_elapsed()
+            if self.paused and self.pause_until <= now:
+                e = 'still paused and not updating pause_until'
+                raise AssertionError(e)
+            return 0
 
+        # end-if self.paused block
+
+        self._become_paused(False)
+
+        wait = self._seconds_until_next_run()
+        if wait > 0:
+            if self.machine_runs_in_flight:
                 self.machine_state = self.RUNNING
-                self.run_once()
+            else:
+                self.machine_state = self.WAITING
+            return wait
+
+        return self._RUN_DUE
 
-            # We trigger the pause mechanism (without changing the
-            # state) to allow the machine to clear up.
-            self.paused = True
-            self._become_paused(True, set_state=False)
+    # Starts a run in the worker pool (if we haven't reached the limit
+    # of concurrent runs).
+    def _dispatch_run(self):
+        # We'll be interrupted when one of the runs completes.
+        if len(self.machine_runs_in_flight) >= self.max_concurrent_runs:
+            return None
 
-            # We may require something to make the machine to finally
-            # stop - this is where subclasses can define what that is.
-            self.on_machine_stopping()
+        if self._machine_run_pool is None:
+            self._machine_run_pool = futures.ThreadPoolExecutor(
+                self.max_concurrent_runs)
 
-            # Machine being brought to a halt.
-            self.machine_state = self.STOPPED
+        run = self._begin_run()
+        self._reschedule_overlapping(run)
+        self._machine_run_pool.submit(self._perform_run, run)
+        return 0
 
-        except Exception as e:
-            self.machine_state = self.FAILED
+    def _machine_shutdown(self):
+        # Let any runs which are still in progress finish.
+        if self._machine_run_pool is not None:
+            self._machine_run_pool.shutdown(wait=True)
+            self._machine_run_pool = None
+
+        # We trigger the pause mechanism (without changing the
+        # state) to allow the machine to clear up.
+        self.paused = True
+        self._become_paused(True, set_state=False)
+
+        # We may require something to make the machine to finally
+        # stop - this is where subclasses can define what that is.
+        self.on_machine_stopping()
+
+        # Machine being brought to a halt.
+        self.machine_state = self.STOPPED
+
+    def _machine_failed(self, e):
+        self.machine_state = self.FAILED
+        self._emit_event('fail', error=e)
 
-            # If an exception occurs trying to report the machine
-            # failure, just dump it to the log and let the original
-            # exception take priority.
+        # If an exception occurs trying to report the machine
+        # failure, just dump it to the log and let the original
+        # exception take priority.
 
+        # noinspection PyBroadException
+        try:
+            self.on_machine_fail(e)
+        except Exception:
             # noinspection PyBroadException
             try:
-                self.on_machine_fail(e)
+                _log('', traceback=True)
             except Exception:
-                # noinspection PyBroadException
-                try:
-                    cherrypy.log(traceback=True)
-                except Exception:
-                    pass
-
-            raise
+                pass
 
     # Helper function to make a thread sleep in a way that it can be
     # interrupted, using a timedelta as a way of expressing the time
@@ -273,58 +1104,303 @@ class BoneMachine(object):
                 'timezone-naive datetimes')
         if now.tzinfo and now.tzinfo != dt.tzinfo:
             raise ValueError('must use same timezones')
-        wait_time = dt - now
-        return wait_time.seconds + (wait_time.microseconds / 1000000.0)
+        return max((dt - now).total_seconds(), 0)
+
+    # Returns how long until run_time_next. This is measured with the
+    # monotonic clock from the point when run_time_next was set, so that
+    # changes to the system clock don't affect when the run takes place.
+    def _seconds_until_next_run(self):
+        run_time_next, deadline = self._machine_deadline
+        if run_time_next != self.run_time_next:
+            run_time_next = self.run_time_next
+            deadline = _monotonic() + self._how_long_until(run_time_next)
+            self._machine_deadline = run_time_next, deadline
+        return deadline - _monotonic()
+
+    def run_in_process(self, func, *args, **kwargs):
+        """Invokes func with the given arguments in the process pool
+        shared between machines (see get_process_pool), and waits for
+        the result. Any exception raised by func will be raised here.
+
+        This allows CPU-bound work performed by execute to avoid
+        contending for the GIL with other machines."""
+        pool = get_process_pool()
+        try:
+            return pool.submit(func, *args, **kwargs).result()
+        except BrokenProcessPool:
+            # A worker process died - discard the pool so the next run
+            # gets a working one.
+            _discard_process_pool(pool)
+            raise
 
     def interrupt(self):
         '''Tell the execution thread to wake up.'''
         self.machine_event_flag.set()
+        if self.machine_scheduler is not None:
+            self.machine_scheduler.wake(self)
+
+    def wait_for_state(self, states, timeout=None):
+        '''Wait (up to timeout seconds) for the machine to be in one of
+        the given states (a single state can also be given). Returns True
+        if it is, or False if the timeout expired first.'''
+        return self._wait_for(self._state_reached(states), timeout) is not None
+
+    def wait_for_run(self, after_id=None, timeout=None):
+        '''Wait (up to timeout seconds) for a run with an id greater than
+        after_id to complete, and return its run object (or None if the
+        timeout expired first).
+
+        If after_id is not given, then this waits for the next run to be
+        completed after this is called.'''
+        return self._wait_for(self._run_completed(after_id), timeout)
+
+    def wait_for_state_async(self, states, timeout=None):
+        '''Equivalent of wait_for_state for asyncio code - this returns
+        an awaitable rather than blocking the calling thread.'''
+        return self._await_for(self._state_reached(states), timeout, False)
+
+    def wait_for_run_async(self, after_id=None, timeout=None):
+        '''Equivalent of wait_for_run for asyncio code - this returns an
+        awaitable rather than blocking the calling thread.'''
+        return self._await_for(self._run_completed(after_id), timeout)
+
+    # The functions below return a function which returns something other
+    # than None when what's being waited for has happened.
+    def _state_reached(self, states):
+        if isinstance(states, str):
+            states = [states]
+        return lambda: True if self.machine_state in states else None
+
+    def _run_completed(self, after_id):
+        if after_id is None:
+            last_run = self.machine_last_run
+            after_id = -1 if last_run is None else last_run.id
+
+        def completed():
+            run = self.machine_last_run
+            if run is not None and run.id > after_id:
+                return run
+            return None
+        return completed
+
+    # Blocks until check returns something other than None (which gets
+    # returned), or returns None if the timeout expires first.
+    def _wait_for(self, check, timeout):
+        deadline = None if timeout is None else _monotonic() + timeout
+        with self._machine_changed:
+            while True:
+                res = check()
+                if res is not None:
+                    return res
+                if deadline is None:
+                    self._machine_changed.wait()
+                    continue
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return None
+                self._machine_changed.wait(remaining)
+
+    # Equivalent of _wait_for which returns an asyncio future instead - it
+    # resolves to default if the timeout expires.
+    def _await_for(self, check, timeout, default=None):
+        import asyncio
+        get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+        loop = get_loop()
+        future = loop.create_future()
+
+        def resolve(res):
+            if not future.done():
+                future.set_result(res)
+
+        def watcher():
+            res = check()
+            if res is None:
+                return future.done()
+            try:
+                loop.call_soon_threadsafe(resolve, res)
+            except RuntimeError:  # The event loop has been closed.
+                pass
+            return True
+
+        with self._machine_changed:
+            res = check()
+            if res is not None:
+                future.set_result(res)
+                return future
+            self._machine_watchers.append(watcher)
+
+        if timeout is not None:
+            loop.call_later(timeout, resolve, default)
+        return future
+
+    def add_observer(self, observer, kinds=None, overflow='drop-oldest'):
+        '''Registers something to be told about events which happen to
+        the machine, in the form of MachineEvent objects. The kinds of
+        event are:
+          'run'    - a run has completed (successfully or not).
+          'error'  - a run has failed (the event includes the error).
+          'pause'  - the machine has become paused.
+          'resume' - the machine has resumed.
+          'fail'   - the machine has halted due to an error.
+
+        If kinds is given (either a single kind, or several of them),
+        then only those kinds of event are passed on.
+
+        The observer can either be a callable, which is invoked with each
+        event, or a queue (such as queue.Queue), which events are put
+        into. Events are delivered by a small pool of threads shared
+        between all machines, so the machine is never held up by its
+        observers. If an observer falls more than a thousand events
+        behind, the oldest ones are discarded (status reports how many
+        have been dropped).
+
+        If a bounded queue is full, then the overflow policy determines
+        what happens - 'drop-oldest' discards the oldest event in the
+        queue, and 'block' holds on to the event until there is space
+        (without holding up any other observers).'''
+        added = _Observer(observer, kinds, overflow)
+        with self._machine_observers_lock:
+            self._machine_observers += (added,)
+
+    def remove_observer(self, observer):
+        '''Removes something registered with add_observer.'''
+        with self._machine_observers_lock:
+            removed = [o for o in self._machine_observers
+                       if o.target is observer]
+            self._machine_observers = tuple(
+                o for o in self._machine_observers if o.target is not observer)
+        for o in removed:
+            o.close()
+
+    def _emit_event(self, kind, run=None, error=None):
+        observers = self._machine_observers
+        if observers:
+            event = MachineEvent(kind, self, run, error)
+            for observer in observers:
+                observer.publish(event)
 
     def run_now(self):
         '''Tell the execution thread to perform an execution now.'''
         self.run_time_next = self.now()
+        self._publish_snapshot()
         self.interrupt()
 
     # Recalculates when the next run should be performed.
-    def _reschedule(self, on_error):
+    def _reschedule(self, run):
+        on_error = run.failed
 
         # Run times might be set by subclasses, so don't override
         # anything explicit.
         if self.run_time_next is not None:
             return
 
-        for time, calc_from_now, use_it in [
+        for wait, calc_from_now, use_it in [
             (self.wait_for_this_one_time, True, True),
             (self.wait_on_error, True, on_error),
             (self.wait_run_frequency, False, True),
             (self.wait_min, True, True),
         ]:
-            if use_it and time is not None and time > 0:
+            if use_it and wait is not None and wait > 0:
                 break
 
         if calc_from_now:
             self.run_time_next = self.run_time_end + \
-                datetime.timedelta(seconds=time)
+                datetime.timedelta(seconds=wait)
         else:
-            self.run_time_next = self.run_time_start + \
-                datetime.timedelta(seconds=time)
+            self.run_time_next = self._next_on_timeline(run, wait)
+        self._add_jitter()
 
         # Invalidate wait_for_this_time if it was set.
         self.wait_for_this_one_time = None
 
+    # Equivalent of _reschedule used when runs can overlap. When a run is
+    # started, the next run is scheduled relative to its start time
+    # (using wait_run_frequency, or wait_min if that isn't set).
+    #
+    # When the run finishes, wait_for_this_one_time and wait_on_error
+    # are applied relative to when it ended - but only if it was the
+    # most recently started run, as runs may finish out of order and
+    # an older run shouldn't drag the schedule back to an earlier time.
+    def _reschedule_overlapping(self, run, on_error=None):
+        if on_error is None:
+            if self.wait_run_frequency:
+                self.run_time_next = self._next_on_timeline(
+                    run, self.wait_run_frequency)
+            else:
+                self.run_time_next = run.time_start + \
+                    datetime.timedelta(seconds=self.wait_min or 0)
+            self._add_jitter()
+            self._publish_snapshot()
+            return
+
+        wait = self.wait_for_this_one_time
+        if not wait and on_error:
+            wait = self.wait_on_error
+        self.wait_for_this_one_time = None
+
+        if wait and run.id == self._run_count - 1:
+            run_time_next = run.time_end + datetime.timedelta(seconds=wait)
+            if self.run_time_next is None or run_time_next > self.run_time_next:
+                self.run_time_next = run_time_next
+
+    # Works out when the run after the given one should take place if
+    # runs are performed at a fixed rate. This is based on when the run
+    # was meant to start rather than when it actually started, so that
+    # waking up late doesn't make the schedule drift - wait_catch_up
+    # determines what happens if we have fallen behind.
+    def _next_on_timeline(self, run, frequency):
+        period = datetime.timedelta(seconds=frequency)
+        if run.time_planned is None:
+            run_time_next = run.time_start + period
+        else:
+            run_time_next = run.time_planned + period - \
+                datetime.timedelta(seconds=run.jitter)
+        behind = (self.now() - run_time_next).total_seconds()
+        if behind <= 0 or self.wait_catch_up == 'burst':
+            return run_time_next
+
+        missed = int(behind // frequency)
+        if self.wait_catch_up == 'skip':
+            missed += 1
+        elif self.wait_catch_up != 'coalesce':
+            raise ValueError(
+                'unknown wait_catch_up value: %r' % self.wait_catch_up)
+        return run_time_next + period * missed
+
+    # Adds a random delay of up to wait_jitter to run_time_next, recording
+    # how much was added so that the run can be placed back on its
+    # timeline afterwards.
+    def _add_jitter(self):
+        if not self.wait_jitter:
+            return
+        jitter = random.uniform(0, self.wait_jitter)
+        self.run_time_next += datetime.timedelta(seconds=jitter)
+        self._run_time_jitter = self.run_time_next, jitter
+
     def __create_machine_run(self):
         # Prepare the run object.
-        self.machine_run = run = Run()
+        run = Run()
         run.time_start = self.run_time_start
+        run.time_planned = self.run_time_next
+        jittered, jitter = self._run_time_jitter
+        if jittered is not None and jittered == run.time_planned:
+            run.jitter = jitter
+        if run.time_planned is not None:
+            run.lag = (run.time_start - run.time_planned).total_seconds()
+            self.machine_start_lag.add(run.lag)
         run.id = self._run_count
         self._run_count += 1
 
-        # Add it to the history list.
+        # Add it to the history - this is a deque which discards the
+        # oldest entries itself, so we only need to replace it if the
+        # limit has changed.
         if self.run_history_limit is not None:
-            self.machine_run_history.append(run)
-            if self.run_history_limit:
-                self.machine_run_history = self.machine_run_history[
-                    -self.run_history_limit:]  # pylint: disable=invalid-unary-operand-type
+            history = self.machine_run_history
+            maxlen = self.run_history_limit or None
+            if history.maxlen != maxlen:
+                history = self.machine_run_history = collections.deque(
+                    history, maxlen)
+            history.append(run)
 
         return run
 
@@ -336,35 +1412,112 @@ class BoneMachine(object):
         takes place around it). You should not execute this in a thread
         separate to the machine thread (unless that thread has ceased
         execution)."""
+        return self._perform_run(self._begin_run())
+
+    # Updates the machine to indicate a run is starting, and returns the
+    # run object for it.
+    def _begin_run(self):
         self.run_time_start = self.now()
         self.run_time_end = None
-        self.run_time_next = None
 
         run = self.__create_machine_run()
+        run.token = CancellationToken(self.run_timeout)
+        if run.token.deadline is not None:
+            _watchdog.watch(self, run)
+        self.run_time_next = None
+        self.machine_runs_in_flight.append(run)
+        self._publish_snapshot()
+        return run
 
+    def _perform_run(self, run):
+        self._machine_local.run = run
+        run.thread_id = _get_ident()
+        run._paused_by_execute = False
         res = None
 
         try:
-            try:
-                run._paused_by_execute = False
-                res = self.execute()
-            finally:
-                self.run_time_end = run.time_end = self.now()
-                paused_by_execute = run.pop('_paused_by_execute')
+            res = self.execute()
+            if self.execute_in_process and callable(res):
+                res = self.run_in_process(res)
         except (KeyboardInterrupt, SystemExit):
-            cherrypy.log("<Ctrl-C> hit: shutting down app engine", "ENGINE")
-            self.stop()
-            cherrypy.server.stop()
-            cherrypy.engine.stop()
+            self._abort_run(run)
+            self._shut_down_engine()
             raise
+        except RunCancelled:
+            run.cancelled = True
+            self._finish_run(run, None)
         except Exception as e:
-            if self.pause_on_error:
-                self.on_machine_pause_due_to_error(e)
-            self.on_machine_error(e)
-            self._reschedule(True)
-            run.failed = True
+            self._finish_run(run, e)
         else:
-            self._reschedule(False)
+            self._finish_run(run, None)
+        return res
+
+    # Used when a run is interrupted by Ctrl-C (or SystemExit).
+    def _shut_down_engine(self):
+        cherrypy = sys.modules.get('cherrypy')
+        if cherrypy is None:
+            _log('<Ctrl-C> hit: stopping %s', self.machine_name)
+            self.stop()
+            return
+        cherrypy.log("<Ctrl-C> hit: shutting down app engine", "ENGINE")
+        self.stop()
+        cherrypy.server.stop()
+        cherrypy.engine.stop()
+
+    # Invoked by the watchdog thread when a run has exceeded run_timeout.
+    def _run_overran(self, run):
+        frame = sys._current_frames().get(run.thread_id)  # pylint: disable=protected-access
+        stack = ''.join(format_stack(frame)) if frame is not None else None
+        run.overrun = True
+        run.overrun_stack = stack
+        run.token.cancel('timeout')
+
+        # noinspection PyBroadException
+        try:
+            self.on_machine_run_overrun(run, stack)
+        except Exception:  # pylint: disable=broad-except
+            _log('', traceback=True)
+
+    def _end_execute(self, run):
+        self.run_time_end = run.time_end = self.now()
+        if run.token.deadline is not None:
+            _watchdog.unwatch(run)
+
+        # The run only counts as cancelled if it was cut short - by
+        # raising RunCancelled, or by returning after being told that the
+        # token was cancelled. Runs which ignore the token and finish
+        # normally aren't (though they may have overrun).
+        if run.token._observed:  # pylint: disable=protected-access
+            run.cancelled = True
+        paused_by_execute, run._paused_by_execute = run._paused_by_execute, None
+        return paused_by_execute
+
+    # Used if execution of a run is abandoned.
+    def _abort_run(self, run):
+        self._end_execute(run)
+        self._machine_local.run = None
+        self.machine_runs_in_flight.remove(run)
+
+    # Deals with the outcome of a run - if it failed, then this must be
+    # called while the exception is being handled.
+    def _finish_run(self, run, error):
+        paused_by_execute = self._end_execute(run)
+        with self._machine_lock:
+            if error is not None:
+                if self.pause_on_error:
+                    self.on_machine_pause_due_to_error(error)
+                self.on_machine_error(error)
+                self._emit_event('error', run, error)
+                run.failed = True
+            self.machine_stats.record(
+                (run.time_end - run.time_start).total_seconds(), run.failed)
+            self._complete_run(run, paused_by_execute)
+
+    def _complete_run(self, run, paused_by_execute):
+        if self.max_concurrent_runs > 1:
+            self._reschedule_overlapping(run, run.failed)
+        else:
+            self._reschedule(run)
 
         # If the execute loop itself caused the service to pause, we
         # then set a flag on the run object and immediately set
@@ -375,9 +1528,18 @@ class BoneMachine(object):
             self._become_paused(True)
 
         run.time_next = self.run_time_next
-        self.on_machine_run_complete()
-        self.machine_run = None
-        return res
+        try:
+            self.on_machine_run_complete()
+        finally:
+            self._machine_local.run = None
+            self.machine_runs_in_flight.remove(run)
+            self.machine_last_run = run
+            self._publish_snapshot()
+            self._emit_event('run', run)
+
+        # Let the machine know that a slot is available for another run.
+        if self.max_concurrent_runs > 1:
+            self.interrupt()
 
     #
     # Variables / methods related to pausing.
@@ -395,7 +1557,10 @@ class BoneMachine(object):
             if set_state:
                 self.machine_state = self.PAUSED
             self.pause_time = self.now()
+            self.machine_pause_count += 1
+            self._machine_paused_since = _monotonic()
             self.on_machine_pause()
+            self._emit_event('pause')
         elif self.machine_state == self.PAUSED and not paused:
             assert not self.paused, (
                 'cannot set machine into resumed state while pause flag '
@@ -404,6 +1569,9 @@ class BoneMachine(object):
             if set_state:
                 self.machine_state = self.RUNNING
             self.pause_time = None
+            self.machine_pause_seconds += \
+                _monotonic() - self._machine_paused_since
+            self._machine_paused_since = None
 
             # This might be a property which is automatically calculated,
             # so we don't care too much if we can't reset it.
@@ -413,6 +1581,7 @@ class BoneMachine(object):
                 pass
 
             self.on_machine_resume()
+            self._emit_event('resume')
 
     #
     # The following methods either need to be overridden by subclasses,
@@ -433,14 +1602,14 @@ class BoneMachine(object):
         occurs outside of the execute block.
 
         Default implementation will log via cherrypy.log."""
-        cherrypy.log(traceback=True)
+        _log('', traceback=True)
 
     def on_machine_fail(self, exception):
         """Hook provided to allow subclasses to react when a fatal
         error has caused the machine service to halt.
 
         Default implementation will call on_error."""
-        cherrypy.log.error('{0.machine_name} failed.'.format(self))
+        _log('%s failed.', self.machine_name, severity=logging.ERROR)
         self.on_machine_error(exception)
 
     def on_machine_run_complete(self):
@@ -474,7 +1643,7 @@ class BoneMachine(object):
         Default implementation will log a message about going into a
         paused state via cherrypy.log.
         """
-        cherrypy.log('{0.machine_name} paused.'.format(self))
+        _log('%s paused.', self.machine_name)
 
     def on_machine_resume(self):
         """Hook provided to allow subclasses to react when the machine
@@ -487,7 +1656,7 @@ class BoneMachine(object):
         Default implementation will log a message about resuming
         execution via cherrypy.log.
         """
-        cherrypy.log('{0.machine_name} resumed.'.format(self))
+        _log('%s resumed.', self.machine_name)
 
     def on_machine_stopping(self):
         '''Hook provided to allow subclasses to react when the machine
@@ -504,6 +1673,19 @@ class BoneMachine(object):
         as it can get.'''
         pass
 
+    def on_machine_run_overrun(self, run, stack):
+        """Hook provided to allow subclasses to react when a run has
+        taken longer than run_timeout. This is invoked from a separate
+        thread, while the run is still in progress.
+
+        stack is the text of the stack of the thread performing the
+        run (or None if it couldn't be determined), to help identify
+        where the run is stuck.
+
+        Default implementation will log the stack via cherrypy.log."""
+        _log('%s run %s has taken longer than %s seconds:\n%s',
+             self.machine_name, run.id, self.run_timeout, stack,
+             severity=logging.WARNING)
 
     def on_machine_pause_due_to_error(self, error):
         """Hook to allow subclasses to react on the event that the
@@ -517,6 +1699,227 @@ class BoneMachine(object):
         self._become_paused(True)
 
 
+class Backpressure(object):
+
+    """Watches a measure of load (such as the size of a queue) against a
+    high and a low watermark. It becomes engaged when the load reaches
+    the high watermark, and stays engaged until the load has fallen back
+    to the low watermark, so it doesn't flap on and off while the load
+    hovers around a single value.
+
+    gauge is either a callable which returns the current load, or an
+    object with a qsize method (such as a queue). If low isn't given, it
+    is half of high.
+
+    Set it as the backpressure of a machine to make the machine pause
+    while it is engaged, or call wait before producing more work to make
+    producers slow down. wait doesn't read the gauge while it blocks - it
+    relies on update being called as the load falls, which machines do as
+    they take work (see QueueMachine) or while paused by it.
+    """
+
+    # How often (in seconds) a machine paused by this reads the gauge.
+    poll_interval = 0.05
+
+    def __init__(self, gauge, high, low=None):
+        if low is None:
+            low = high / 2.0
+        if low > high:
+            raise ValueError('low watermark (%s) is above high watermark '
+                             '(%s)' % (low, high))
+        self.gauge = gauge if callable(gauge) else gauge.qsize
+        self.high = high
+        self.low = low
+        self.level = None
+        self.engaged = False
+
+        # How many times we have been engaged or released, and when
+        # that last happened.
+        self.transitions = 0
+        self.time_transition = None
+        self._changed = threading.Condition(threading.Lock())
+
+    def update(self):
+        """Reads the gauge, and returns whether backpressure is now
+        engaged."""
+        level = self.gauge()
+        with self._changed:
+            self.level = level
+            if self.engaged:
+                engaged = level > self.low
+            else:
+                engaged = level >= self.high
+            if engaged != self.engaged:
+                self.engaged = engaged
+                self.transitions += 1
+                self.time_transition = _utcnow()
+                self._changed.notify_all()
+            return engaged
+
+    def wait(self, timeout=None):
+        """Blocks until backpressure is released, or until timeout seconds
+        have passed. Returns True if it has been released."""
+        if not self.update():
+            return True
+        deadline = None if timeout is None else _monotonic() + timeout
+        with self._changed:
+            while self.engaged:
+                if deadline is None:
+                    self._changed.wait()
+                    continue
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
+
+    def as_dict(self):
+        return dict(
+            engaged=self.engaged,
+            level=self.level,
+            high=self.high,
+            low=self.low,
+            transitions=self.transitions,
+            time_transition=self.time_transition,
+        )
+
+
+# Identifies this process (and lease object) as the holder of a lease.
+_lease_counter = itertools.count()
+
+
+def _lease_holder():
+    import socket
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(),
+                         next(_lease_counter))
+
+
+class SQLiteLease(object):
+
+    """A lease backend for Machine.lease, which records who holds the
+    lease for each machine in an SQLite database. Any number of processes
+    (on hosts which can safely share the database file) can use it to
+    decide which of them runs each machine.
+
+    A lease lasts for ttl seconds, and is renewed by the holder every
+    third of that - if the holder goes away, another process will take
+    over within ttl + ttl / 3 seconds. Runs shouldn't take longer than
+    ttl, as the lease can't be renewed while a run is in progress.
+    """
+
+    def __init__(self, path, ttl=30, holder=None):
+        self.path = path
+        self.ttl = ttl
+        self.renew_interval = ttl / 3.0
+        self.holder = holder or _lease_holder()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            import sqlite3
+            conn = sqlite3.connect(
+                self.path, timeout=self.renew_interval,
+                isolation_level=None, check_same_thread=False)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS machinerry_leases ('
+                'name TEXT PRIMARY KEY, holder TEXT NOT NULL, '
+                'expires REAL NOT NULL)')
+            self._conn = conn
+        return self._conn
+
+    def acquire(self, name):
+        """Acquires the lease for name (or renews it if we already hold
+        it). Returns True if we hold the lease."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Expiry times are shared between processes, so they have
+                # to be in terms of the system clock.
+                now = time.time()
+                row = conn.execute(
+                    'SELECT holder, expires FROM machinerry_leases '
+                    'WHERE name = ?', (name,)).fetchone()
+                held = row is None or row[0] == self.holder or row[1] <= now
+                if held:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO machinerry_leases '
+                        'VALUES (?, ?, ?)',
+                        (name, self.holder, now + self.ttl))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return held
+
+    def release(self, name):
+        """Gives up the lease for name, if we hold it."""
+        with self._lock:
+            self._connect().execute(
+                'DELETE FROM machinerry_leases WHERE name = ? AND holder = ?',
+                (name, self.holder))
+
+    def close(self):
+        """Closes the connection to the database."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class FileLease(object):
+
+    """A lease backend for Machine.lease, which uses fcntl locks on files
+    in a directory (one for each machine) - so it is only available on
+    Unix, and only works between processes on the same host (or which
+    share a filesystem with reliable locking).
+
+    The operating system releases the lock as soon as the holding process
+    exits, so another process will take over within retry_interval
+    seconds.
+    """
+
+    def __init__(self, directory, retry_interval=5):
+        self.directory = directory
+        self.renew_interval = retry_interval
+        self.holder = _lease_holder()
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name):
+        """Acquires the lock for name (if we don't hold it already).
+        Returns True if we hold it."""
+        import fcntl
+        with self._lock:
+            if name in self._files:
+                return True
+            filename = '%s.lock' % name.replace(os.sep, '_')
+            f = open(os.path.join(self.directory, filename), 'a')
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                f.close()
+                return False
+            self._files[name] = f
+            return True
+
+    def release(self, name):
+        """Releases the lock for name, if we hold it."""
+        with self._lock:
+            f = self._files.pop(name, None)
+        if f is not None:
+            f.close()  # This releases the lock.
+
+    def close(self):
+        """Releases all of the locks we hold."""
+        with self._lock:
+            files = list(self._files.values())
+            self._files.clear()
+        for f in files:
+            f.close()
+
+
 #
 # We build the extensions related to pausing into this subclass.
 #
@@ -563,6 +1966,35 @@ class Machine(BoneMachine):
     # Shall we start paused?
     pause_on_start = False
 
+    # Shall we pause if a run takes longer than run_timeout?
+    pause_on_overrun = False
+
+    # A Backpressure object - if set, the machine pauses itself while it
+    # is engaged, and resumes once it is released (unless the machine
+    # has been paused for some other reason in the meantime).
+    backpressure = None
+
+    # The pause reason we gave if we paused due to backpressure.
+    _backpressure_reason = None
+
+    # A lease backend (such as SQLiteLease or FileLease) - if set, the
+    # machine only performs runs while it holds the lease for its name,
+    # so that only one of the processes sharing the backend runs it. The
+    # others wait in the STANDBY state, and take over if the lease isn't
+    # renewed. The machine gives up the lease when it stops, but doesn't
+    # close the backend (as it may be shared with other machines) - that
+    # is left to whoever created it.
+    lease = None
+
+    # Whether we hold the lease, and when we last acquired or renewed it
+    # (as a monotonic time).
+    _lease_held = False
+    _lease_renewed = None
+
+    # The StatusNotifier which status alerts are sent through (see
+    # notify_status_via_email). If None, alerts are only recorded.
+    status_notifier = None
+
     _pause_until = None
 
     @property
@@ -635,6 +2067,106 @@ class Machine(BoneMachine):
         self.pause_time = self.pause_actor = self.pause_reason = None
         self.notify_status_via_email()
 
+    # Only run while we hold the lease (if we have one), and pause or
+    # resume according to the backpressure (if we have any).
+    def _machine_poll(self):
+        lease = self.lease
+        if lease is not None and not self._hold_lease(lease):
+            # Don't lose track of being paused.
+            if self.machine_state != self.PAUSED:
+                self.machine_state = self.STANDBY
+            return lease.renew_interval
+
+        backpressure = self.backpressure
+        if backpressure is not None:
+            self._apply_backpressure(backpressure)
+        wait = super(Machine, self)._machine_poll()
+        if wait is self._RUN_DUE:
+            return wait
+
+        # Keep an eye on the gauge while it is holding us up, and renew
+        # the lease before it expires.
+        limits = []
+        if self._backpressure_reason is not None:
+            limits.append(backpressure.poll_interval)
+        if lease is not None:
+            limits.append(lease.renew_interval)
+        for limit in limits:
+            if wait is None or wait > limit:
+                wait = limit
+        return wait
+
+    # Acquires or renews the lease for this machine if it is due to be
+    # renewed, returning whether we hold it.
+    def _hold_lease(self, lease):
+        now = _monotonic()
+        if self._lease_held and \
+                now - self._lease_renewed < lease.renew_interval:
+            return True
+
+        # If we can't tell whether we hold the lease, it's safer to
+        # assume that we don't.
+        try:
+            held = lease.acquire(self.machine_name)
+        except Exception:  # pylint: disable=broad-except
+            _log('', traceback=True)
+            held = False
+
+        if held != self._lease_held:
+            if held:
+                _log('%s acquired lease as %s.', self.machine_name,
+                     lease.holder)
+            else:
+                _log('%s does not hold lease - on standby.',
+                     self.machine_name)
+        self._lease_held = held
+        self._lease_renewed = now if held else None
+        return held
+
+    def _release_lease(self):
+        if self.lease is not None and self._lease_held:
+            self._lease_held = False
+            self._lease_renewed = None
+            # noinspection PyBroadException
+            try:
+                self.lease.release(self.machine_name)
+            except Exception:  # pylint: disable=broad-except
+                _log('', traceback=True)
+
+    def _machine_shutdown(self):
+        super(Machine, self)._machine_shutdown()
+        self._release_lease()
+
+    def _machine_failed(self, e):
+        self._release_lease()
+        super(Machine, self)._machine_failed(e)
+
+    # Pauses or resumes the machine if backpressure has been engaged or
+    # released since we last looked.
+    def _apply_backpressure(self, backpressure):
+        engaged = backpressure.update()
+        if engaged and not self.paused:
+            # Unlike pause_for_reason, runs which are already in progress
+            # aren't cancelled - they are left to finish.
+            self._paused = True
+            self.pause_actor = None
+            self.pause_reason = self._backpressure_reason = (
+                'automatic pause due to backpressure (%s reached %s).' % (
+                    backpressure.level, backpressure.high))
+            self.interrupt()
+            _log('%s set to pause - %s', self.machine_name, self.pause_reason)
+        elif not engaged and self._backpressure_reason is not None:
+            if self.paused and self.pause_reason == self._backpressure_reason:
+                self.resume_by(None)
+            self._backpressure_reason = None
+
+    # Pause if requested when a run takes too long.
+    def on_machine_run_overrun(self, run, stack):
+        super(Machine, self).on_machine_run_overrun(run, stack)
+        if self.pause_on_overrun:
+            self.pause_for_reason(
+                None, 'automatic pause due to run exceeding run_timeout.')
+
     # Record the reason why we're pausing and generate an immediate
     # e-mail.
     def on_machine_pause_due_to_error(self, error):
@@ -739,13 +2271,10 @@ class Machine(BoneMachine):
         self.pause_actor = actor['username']
         self.pause_reason = reason
 
-        msg_actor = (
-            '{0.machine_name} set to pause by {0.pause_actor_text} - '
-            '{0.pause_reason}'
-        )
-        msg_no_actor = '{0.machine_name} set to pause - {0.pause_reason}'
+        msg_actor = '%s set to pause by %s - %s'
+        msg_no_actor = '%s set to pause - %s'
 
-        cherrypy.log(msg_actor.format(self))
+        _log(msg_actor, self.machine_name, self.pause_actor_text, reason)
 
     def resume_by(self, actor):
         """Tells the machine to resume, and indicates who is requesting
@@ -773,83 +2302,1383 @@ class Machine(BoneMachine):
         self.pause_actor = actor['username']
         self.pause_reason = None
 
-        msg_actor = '{0.machine_name} set to resume by {1}.'
-        msg_no_actor = '{0.machine_name} set to resume.'
+        msg_actor = '%s set to resume by %s.'
+        msg_no_actor = '%s set to resume.'
 
-        cherrypy.log(msg_actor.format(self, actor['username']))
+        _log(msg_actor, self.machine_name, actor['username'])
 
     def notify_status_via_email(self, message=None):
+        """Records that a status alert has been generated, and passes it
+        on to status_notifier (if set) to be sent in the background."""
         self.pause_alert_last = self.now()
-        self.pause_alert_count += 1
+        self.pause_alert_count = (self.pause_alert_count or 0) + 1
+        if self.status_notifier is not None:
+            self.status_notifier.notify(
+                self.machine_name, self.machine_state,
+                self.format_notify_status_lines(self._status_lines(message)))
+
+    # The lines of text describing the machine in a status alert.
+    def _status_lines(self, message):
+        lines = ['Status: %s' % self.machine_state]
+        if self.pause_time is not None:
+            lines.append('Paused by: %s' % self.pause_actor_text)
+            lines.append('Paused for: %s' % self.pause_time_text)
+            if self.pause_reason:
+                lines.append('Reason: %s' % self.pause_reason)
+        elif self.pause_actor is not None:
+            lines.append('Resumed by: %s' % (self.pause_actor or 'itself'))
+        if message:
+            lines.append(message)
+        return lines
+
+    def format_notify_status_lines(self, lines):
+        """Hook provided to allow subclasses to modify the lines of text
+        describing the machine in a status alert. Returns the lines to
+        use."""
+        return lines
 
     def subscribe(self):
+        import cherrypy
         e = cherrypy.engine
         e.subscribe('start', self.start)
         e.subscribe('stop', self.stop)
+        register_machine(self)
 
     def unsubscribe(self):
+        import cherrypy
         e = cherrypy.engine
         e.unsubscribe('start', self.start)
         e.unsubscribe('stop', self.stop)
+        unregister_machine(self)
 
-    def override_signal_handler(self):
+    def override_signal_handler(self, timeout=None):
         """Integrates with CherryPy's signal handling mechanism so that
-        it will only shut down the web service once the main thread
-        itself has terminated.
+        it will only shut down the web service once the machine has
+        stopped (see install_shutdown_handler, which this uses - all
+        registered machines are stopped together).
 
         Returns true if it was modified successfully.
         """
-        try:
-            handler = cherrypy.engine.signal_handler
-        except AttributeError:
-            return False
-
-        old_sigterm_handler = handler.handlers['SIGTERM']
-
-        def delayed_stop():
-            our_thread = self.machine_thread
-            self.stop() # This will clear the reference to the machine thread.
-
-            # We don't want multiple signals to cause this service
-            # to halt. We trust that after the main thread has
-            # finished, we will pass on the signal. We won't allow
-            # any other signals to make their way through.
-            handler.handlers['SIGTERM'] = lambda: None
-
-            # Just in case we're triggered more than once, we protect
-            # against the possibility that we receive the signal more
-            # than once.
-            if our_thread:
-                cherrypy.log(
-                    'Waiting for thread "%s" to terminate before shutting '
-                    'down.' % our_thread.name
-                )
-                our_thread.join()
-                cherrypy.log('Thread "%s" terminated.' % our_thread.name)
-
-            # Shut down everything else.
-            old_sigterm_handler()
-
-        handler.handlers['SIGTERM'] = delayed_stop
-        handler.subscribe()
-        return True
+        register_machine(self)
+        return install_shutdown_handler(timeout)
 
     def status(self):
         '''Returns a dictionary describing the current state of the
         machine. Intended to be called from any thread. Subclasses are
-        encouraged to override the definition to include additional data.'''
+        encouraged to override the definition to include additional data.
+
+        The state and times are taken from machine_snapshot, so they are
+        always consistent with each other. If you only want to know if
+        they have changed, you can compare the generation included here
+        with that of machine_snapshot.'''
+        snapshot = self.machine_snapshot
         res = dict(
-            state=self.machine_state,
+            state=snapshot.state,
+            generation=snapshot.generation,
             times=dict(
-                start=self.run_time_start,
-                next=self.run_time_next,
+                start=snapshot.time_start,
+                next=snapshot.time_next,
+            )
+        )
+        if snapshot.time_end is not None:
+            res['times']['end'] = snapshot.time_end
+
+        if snapshot.up_since is not None:
+            res['uptime'] = (self.now() - snapshot.up_since).seconds
+
+        res['active'] = snapshot.state in (self.RUNNING, self.WAITING)
+        res['stats'] = self.machine_stats.as_dict()
+        res['lag'] = dict(
+            start=self.machine_start_lag.as_dict(),
+            wakeup=self.machine_wakeup_lag.as_dict(),
+        )
+        observers = self._machine_observers
+        if observers:
+            res['observers'] = dict(
+                count=len(observers),
+                pending=sum(len(o.buffer) for o in observers),
+                dropped=sum(o.dropped for o in observers),
             )
+        if self.backpressure is not None:
+            res['backpressure'] = self.backpressure.as_dict()
+        if self.lease is not None:
+            res['lease'] = dict(
+                held=self._lease_held,
+                holder=self.lease.holder,
+            )
+        return res
+
+
+# noinspection PyAbstractClass
+class QueueMachine(Machine):
+
+    """A machine which processes items put on its queue, performing a run
+    as soon as items arrive rather than polling for them.
+
+    Subclasses override execute_batch, which is given a list of the items
+    taken from the queue for the run:
+
+    >>> class MyMachine(QueueMachine):
+    ...    def execute_batch(self, items):
+    ...        foo(items)
+    >>> m = MyMachine('test')
+    >>> m.put('bar')
+
+    Runs are performed back to back while there are items on the queue.
+    If a run fails and wait_on_error is set, that still determines when
+    the next run takes place.
+    """
+
+    # The maximum number of items to pass to execute_batch in a run.
+    batch_size = 100
+
+    # How long to wait (in seconds) for a batch to fill up once the first
+    # item has been taken from the queue. By default, we only take the
+    # items which are already on the queue.
+    batch_wait = 0
+
+    # The maximum number of items which the queue can hold - put will
+    # block when it is full. Zero means no limit.
+    queue_size = 0
+
+    # If set, put will block once this many items are on the queue, until
+    # the queue has been drained down to queue_low items (see
+    # queue_backpressure). Machines producing items for this one can also
+    # use queue_backpressure as their backpressure, to pause instead.
+    queue_high = None
+    queue_low = None
+
+    # As runs are performed when items arrive, this only determines how
+    # often execute is invoked while the queue is empty.
+    wait_min = 60
+
+    # The class of queue to use - it is created with queue_size.
+    queue_class = queue.Queue
+
+    def __init__(self, name):
+        super(QueueMachine, self).__init__(name)
+        self.machine_queue = self.queue_class(self.queue_size)
+        self.queue_backpressure = None
+        if self.queue_high is not None:
+            self.queue_backpressure = Backpressure(
+                self.machine_queue, self.queue_high, self.queue_low)
+
+    def put(self, item, block=True, timeout=None):
+        """Adds an item to the queue, waking up the machine to process
+        it. The arguments behave as they do for Queue.put - including
+        when we are waiting for the queue to drain after reaching
+        queue_high."""
+        backpressure = self.queue_backpressure
+        if backpressure is not None:
+            if not backpressure.wait(timeout if block else 0):
+                raise queue.Full
+        self.machine_queue.put(item, block, timeout)
+        self.interrupt()
+
+    def put_nowait(self, item):
+        """Adds an item to the queue without blocking, raising queue.Full
+        if there is no room for it."""
+        self.put(item, block=False)
+
+    def _seconds_until_next_run(self):
+        wait = super(QueueMachine, self)._seconds_until_next_run()
+        if wait <= 0 or self.machine_queue.empty():
+            return wait
+
+        # Don't cut short the wait after a failure.
+        last_run = self.machine_last_run
+        if self.wait_on_error and last_run is not None and last_run.failed:
+            return wait
+
+        # The run is starting early, so it's planned for now - otherwise
+        # it would be recorded as having started before it was due.
+        self.run_time_next = self.now()
+        return 0
+
+    def take_batch(self):
+        """Removes the items to process in a run from the queue (up to
+        batch_size of them, waiting up to batch_wait seconds for more to
+        arrive after the first) and returns them in a list."""
+        get = self.machine_queue.get
+        items = []
+        deadline = None
+        while len(items) < self.batch_size:
+            remaining = 0 if deadline is None else deadline - _monotonic()
+            try:
+                if remaining > 0:
+                    item = get(True, remaining)
+                else:
+                    item = get(False)
+            except queue.Empty:
+                break
+            if self._accept_item(item):
+                items.append(item)
+                if deadline is None:
+                    deadline = _monotonic() + self.batch_wait
+
+        # Let producers waiting on queue_backpressure know if the queue
+        # has drained enough.
+        if self.queue_backpressure is not None:
+            self.queue_backpressure.update()
+        return items
+
+    # Invoked by take_batch with each item taken from the queue - returns
+    # whether it should be included in the batch.
+    def _accept_item(self, item):
+        return True
+
+    def execute(self):
+        items = self.take_batch()
+        if items:
+            return self.execute_batch(items)
+        return None
+
+    def execute_batch(self, items):
+        """Processes the items taken from the queue for a run. Subclasses
+        must override this."""
+        raise NotImplementedError
+
+    def status(self):
+        res = super(QueueMachine, self).status()
+        res['queue'] = self.machine_queue.qsize()
+        if self.queue_backpressure is not None:
+            res['queue_backpressure'] = self.queue_backpressure.as_dict()
+        return res
+
+
+# A job queued on a PriorityQueueMachine. deadline and time_queued are
+# in terms of the monotonic clock.
+Job = collections.namedtuple('Job', [
+    'item', 'priority', 'deadline', 'time_queued',
+])
+
+
+# The queue used by PriorityQueueMachine - jobs are taken in order of
+# priority and then deadline (and then the order they were added in).
+class _JobQueue(queue.Queue):
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.depths = collections.defaultdict(int)
+        self._counter = itertools.count()
+
+    def _qsize(self, *args):
+        return len(self.queue)
+
+    def _put(self, job, *args):
+        deadline = float('inf') if job.deadline is None else job.deadline
+        entry = (job.priority, deadline, next(self._counter), job)
+        heapq.heappush(self.queue, entry)
+        self.depths[job.priority] += 1
+
+    def _get(self, *args):
+        job = heapq.heappop(self.queue)[-1]
+        self.depths[job.priority] -= 1
+        return job
+
+    def priority_depths(self):
+        with self.mutex:
+            return dict((p, n) for (p, n) in self.depths.items() if n)
+
+
+# noinspection PyAbstractClass
+class PriorityQueueMachine(QueueMachine):
+
+    """A QueueMachine where each item is queued with a priority and an
+    optional deadline. Runs take the jobs with the lowest priority value
+    first, and jobs with the same priority in order of their deadline -
+    so urgent work doesn't wait behind bulk work which was queued before
+    it.
+
+    Jobs which are still queued when their deadline passes aren't
+    processed - they are passed to on_machine_job_expired instead, which
+    can be overridden to send them elsewhere.
+
+    execute_batch is given a list of Job tuples, rather than the items
+    themselves.
+    """
+
+    queue_class = _JobQueue
+
+    def __init__(self, name):
+        super(PriorityQueueMachine, self).__init__(name)
+
+        # How long jobs of each priority have recently waited in the
+        # queue before being taken, and how many have expired.
+        self.machine_job_wait = collections.defaultdict(RollingStats)
+        self.machine_jobs_expired = collections.defaultdict(int)
+
+    def put(self, item, block=True, timeout=None, **kwargs):
+        """Adds an item to the queue with the given priority (lower values
+        are taken first), waking up the machine to process it. If
+        deadline is given, the item will be discarded if it hasn't been
+        taken from the queue within that many seconds.
+
+        priority and deadline can only be given as keyword arguments -
+        block and timeout behave as they do for QueueMachine.put."""
+        priority = kwargs.pop('priority', 0)
+        deadline = kwargs.pop('deadline', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' %
+                            ', '.join(sorted(kwargs)))
+        now = _monotonic()
+        if deadline is not None:
+            deadline += now
+        job = Job(item, priority, deadline, now)
+        super(PriorityQueueMachine, self).put(job, block, timeout)
+
+    def put_nowait(self, item, **kwargs):
+        """Adds an item to the queue without blocking, raising queue.Full
+        if there is no room for it. priority and deadline are passed on
+        to put."""
+        self.put(item, block=False, **kwargs)
+
+    # Expired jobs are handed to on_machine_job_expired instead, and
+    # don't count towards batch_size.
+    def _accept_item(self, job):
+        now = _monotonic()
+        if job.deadline is not None and job.deadline < now:
+            self.machine_jobs_expired[job.priority] += 1
+            self.on_machine_job_expired(job)
+            return False
+        self.machine_job_wait[job.priority].add(now - job.time_queued)
+        return True
+
+    def on_machine_job_expired(self, job):
+        """Hook invoked with each job which has passed its deadline
+        before it could be processed. Default implementation will log
+        that it has been dropped."""
+        _log('%s dropping job with priority %s which passed its deadline.',
+             self.machine_name, job.priority, severity=logging.DEBUG)
+
+    def status(self):
+        res = super(PriorityQueueMachine, self).status()
+        depths = self.machine_queue.priority_depths()
+        waits = dict(self.machine_job_wait)
+        expired = dict(self.machine_jobs_expired)
+        no_waits = RollingStats()
+        res['priorities'] = dict(
+            (priority, dict(
+                depth=depths.get(priority, 0),
+                wait=waits.get(priority, no_waits).as_dict(),
+                expired=expired.get(priority, 0),
+            )) for priority in set(depths) | set(waits) | set(expired)
         )
-        if self.run_time_end is not None:
-            res['times']['end'] = self.run_time_end
+        return res
+
+
+# Yields the path and stat result of each file in a directory.
+def _list_files(path):
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:  # Python 2.
+        for name in os.listdir(path):
+            filepath = os.path.join(path, name)
+            try:
+                st = os.stat(filepath)
+            except OSError:  # Removed since we listed it.
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield filepath, st
+        return
+
+    for entry in scandir(path):
+        try:
+            if entry.is_file():
+                yield entry.path, entry.stat()
+        except OSError:  # Removed since we listed it.
+            continue
+
+
+# Receives notifications of changes to the files in a directory from
+# inotify (through ctypes, so it's only available on Linux).
+class _Inotify(object):
+
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+    # IN_ONLYDIR - we wait for files to be closed rather than reporting
+    # each write, so we don't report files which are still being written.
+    MASK = 0x8 | 0x40 | 0x80 | 0x200 | 0x1000000
+
+    # Set when events have been lost because too many were queued up.
+    IN_Q_OVERFLOW = 0x4000
+
+    # Set when the event is for a directory rather than a file.
+    IN_ISDIR = 0x40000000
+
+    EVENT = '=iIII'
+
+    def __init__(self, path):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.path = path
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        encoded = path if isinstance(path, bytes) else path.encode(
+            sys.getfilesystemencoding())
+        if libc.inotify_add_watch(self.fd, encoded, self.MASK) < 0:
+            errno = ctypes.get_errno()
+            self.close()
+            raise OSError(errno, 'inotify_add_watch failed', path)
+
+    # Waits for up to timeout seconds for changes, and returns the paths
+    # which have changed - or None if events were lost.
+    def read(self, timeout):
+        import select
+        import struct
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        data = os.read(self.fd, 65536)
+        header = struct.calcsize(self.EVENT)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = struct.unpack_from(self.EVENT, data, offset)
+            name = data[offset + header:offset + header + length]
+            offset += header + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if mask & self.IN_ISDIR:  # We only watch files.
+                continue
+            name = name.rstrip(b'\0')
+            if name:
+                if not isinstance(self.path, bytes):
+                    name = name.decode(sys.getfilesystemencoding())
+                changed.add(os.path.join(self.path, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher(object):
+
+    """Detects changes to the files in a directory - files which have been
+    added, modified or removed.
+
+    If inotify is available (and use_inotify is true), changes are
+    reported by the kernel as they happen, so the cost of watching the
+    directory depends on how much changes rather than how many files it
+    holds. Otherwise, the directory is scanned, comparing the inode,
+    modification time and size of each file with what it was before.
+    """
+
+    def __init__(self, path, use_inotify=True):
+        self.path = path
+        self.use_inotify = use_inotify
+
+        # The state of each file when we last scanned the directory.
+        self.files = {}
+
+        # How we are watching the directory - 'inotify' or 'scan'.
+        self.mode = None
+
+    def scan(self):
+        """Scans the directory, returning the set of paths which have
+        changed since the last scan (all of them, on the first scan)."""
+        files = {}
+        changed = set()
+        for path, st in _list_files(self.path):
+            files[path] = state = (st.st_ino, st.st_mtime, st.st_size)
+            if self.files.get(path) != state:
+                changed.add(path)
+        changed.update(path for path in self.files if path not in files)
+        self.files = files
+        return changed
+
+    def watch(self, on_change, stopped, interval=1):
+        """Calls on_change with the set of paths which have changed
+        whenever there are changes (starting with all the files in the
+        directory), until the stopped event is set. interval determines
+        how often the directory is scanned if we aren't using inotify,
+        and how long it may take to notice stopped being set."""
+        inotify = None
+        if self.use_inotify:
+            try:
+                inotify = _Inotify(self.path)
+            except (AttributeError, OSError):
+                pass
+        self.mode = 'scan' if inotify is None else 'inotify'
+
+        try:
+            changed = self.scan()
+            while not stopped.is_set():
+                if changed:
+                    on_change(changed)
+                if inotify is None:
+                    stopped.wait(interval)
+                    changed = self.scan()
+                else:
+                    changed = inotify.read(interval)
+                    if changed is None:
+                        changed = self.scan() | set(self.files)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+
+# noinspection PyAbstractClass
+class FileWatchMachine(Machine):
+
+    """A machine which performs a run when files in a directory (set in
+    watch_path) are added, modified or removed, rather than rescanning
+    the directory on a timer.
+
+    Subclasses override execute_changes, which is given a sorted list of
+    the paths which have changed since the last run:
+
+    >>> class MyMachine(FileWatchMachine):
+    ...    watch_path = '/var/spool/foo'
+    ...    def execute_changes(self, paths):
+    ...        foo(paths)
+    >>> m = MyMachine('test')
+
+    Changes are detected with inotify where available (see
+    DirectoryWatcher). The first run is given all of the files which are
+    already in the directory. If a run fails, its paths are included in
+    the next run.
+    """
+
+    # The directory to watch.
+    watch_path = None
+
+    # How often (in seconds) to scan the directory if we can't use
+    # inotify.
+    watch_interval = 1
+
+    # Whether to use inotify if it is available.
+    watch_inotify = True
+
+    # As runs are performed when files change, this only determines how
+    # often execute is invoked while nothing is changing.
+    wait_min = 60
+
+    def __init__(self, name):
+        super(FileWatchMachine, self).__init__(name)
+        self.machine_watcher = None
+        self._watch_changes = set()
+        self._watch_lock = threading.Lock()
+        self._watch_stopped = None
+
+    def _machine_startup(self):
+        # Otherwise we would end up watching the current directory.
+        if self.watch_path is None:
+            raise ValueError('watch_path has not been set')
+        super(FileWatchMachine, self)._machine_startup()
+        self.machine_watcher = DirectoryWatcher(
+            self.watch_path, self.watch_inotify)
+        self._watch_stopped = stopped = threading.Event()
+        thread = threading.Thread(
+            target=self._watch, args=(self.machine_watcher, stopped))
+        thread.name = '%s watcher' % self.machine_name
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self, watcher, stopped):
+        while not stopped.is_set():
+            try:
+                watcher.watch(self._files_changed, stopped,
+                              self.watch_interval)
+            except Exception:  # pylint: disable=broad-except
+                _log('', traceback=True)
+                stopped.wait(self.watch_interval)
+
+    def _stop_watching(self):
+        if self._watch_stopped is not None:
+            self._watch_stopped.set()
+            self._watch_stopped = None
+
+    def _machine_shutdown(self):
+        self._stop_watching()
+        super(FileWatchMachine, self)._machine_shutdown()
+
+    def _machine_failed(self, e):
+        self._stop_watching()
+        super(FileWatchMachine, self)._machine_failed(e)
+
+    # Invoked by the watcher thread.
+    def _files_changed(self, paths):
+        with self._watch_lock:
+            self._watch_changes.update(paths)
+        self.run_now()
+
+    def execute(self):
+        with self._watch_lock:
+            paths, self._watch_changes = self._watch_changes, set()
+        if not paths:
+            return None
+        try:
+            return self.execute_changes(sorted(paths))
+        except Exception:
+            with self._watch_lock:
+                self._watch_changes.update(paths)
+            raise
 
-        if self.machine_up_since is not None:
-            res['uptime'] = (self.now() - self.machine_up_since).seconds
+    def execute_changes(self, paths):
+        """Processes the paths which have changed. Subclasses must
+        override this."""
+        raise NotImplementedError
 
-        res['active'] = self.machine_active
+    def status(self):
+        res = super(FileWatchMachine, self).status()
+        watcher = self.machine_watcher
+        with self._watch_lock:
+            pending = len(self._watch_changes)
+        res['watch'] = dict(
+            path=self.watch_path,
+            mode=None if watcher is None else watcher.mode,
+            pending=pending,
+        )
         return res
+
+
+class PartitionedMachine(object):
+
+    """A single logical machine whose work is divided between a number of
+    partitions by key (such as a tenant). Each partition is a machine of
+    its own - created by invoking machine_class with a name derived from
+    the given one, and any additional arguments - so each one has its
+    own thread, schedule, pause state and run history, and a slow key
+    only holds up the keys in the same partition.
+
+    Keys are assigned to partitions by a stable hash, so a key belongs to
+    the same partition every time. Work can be given to partitions with
+    put (if they are QueueMachines), or partitions can pick out their
+    own keys with keys_for - each partition has machine_partition set to
+    its index, and machine_partitioned set to this object:
+
+    >>> class TenantMachine(Machine):
+    ...    def execute(self):
+    ...        tenants = self.machine_partitioned.keys_for(
+    ...            self.machine_partition, get_tenants())
+    ...        foo(tenants)
+    >>> m = PartitionedMachine('test', TenantMachine, 4)
+    >>> m.subscribe()  # doctest: +SKIP
+    """
+
+    def __init__(self, name, machine_class, count, *args, **kwargs):
+        if count < 1:
+            raise ValueError('need at least one partition')
+        self.machine_name = name
+        self.partitions = []
+        for index in range(count):
+            machine = machine_class(
+                '%s[%d]' % (name, index), *args, **kwargs)
+            machine.machine_partition = index
+            machine.machine_partitioned = self
+            self.partitions.append(machine)
+
+    def partition_index(self, key):
+        """Returns the index of the partition which the key belongs to."""
+        if not isinstance(key, (bytes, type(u''))):
+            key = str(key)
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % len(self.partitions)
+
+    def partition_for(self, key):
+        """Returns the partition which the key belongs to."""
+        return self.partitions[self.partition_index(key)]
+
+    def keys_for(self, index, keys):
+        """Returns a list of the given keys which belong to the partition
+        with the given index."""
+        return [key for key in keys if self.partition_index(key) == index]
+
+    def put(self, key, item, *args, **kwargs):
+        """Puts an item on the queue of the partition which the key
+        belongs to - any additional arguments are passed on to its put
+        method."""
+        self.partition_for(key).put(item, *args, **kwargs)
+
+    def start(self):
+        """Starts all of the partitions."""
+        for machine in self.partitions:
+            machine.start()
+
+    def stop(self):
+        """Stops all of the partitions."""
+        for machine in self.partitions:
+            machine.stop()
+
+    def subscribe(self):
+        for machine in self.partitions:
+            machine.subscribe()
+
+    def unsubscribe(self):
+        for machine in self.partitions:
+            machine.unsubscribe()
+
+    def run_now(self):
+        """Tells all of the partitions to perform a run now."""
+        for machine in self.partitions:
+            machine.run_now()
+
+    def pause_for_reason(self, actor, reason, index=None):
+        """Pauses the partition with the given index (or all of them) -
+        see Machine.pause_for_reason."""
+        for machine in self._selected(index):
+            machine.pause_for_reason(actor, reason)
+
+    def resume_by(self, actor, index=None):
+        """Resumes the partition with the given index (or all of them) -
+        see Machine.resume_by."""
+        for machine in self._selected(index):
+            machine.resume_by(actor)
+
+    def _selected(self, index):
+        if index is None:
+            return self.partitions
+        return [self.partitions[index]]
+
+    def status(self):
+        """Returns a dictionary describing all of the partitions - with
+        the status of each one, how many are in each state, and the
+        statistics of the runs performed by all of them."""
+        partitions = [machine.status() for machine in self.partitions]
+        states = collections.defaultdict(int)
+        stats = RunStats()
+        for machine, status in zip(self.partitions, partitions):
+            states[status['state']] += 1
+            stats.merge(machine.machine_stats)
+        return dict(
+            states=dict(states),
+            active=any(status['active'] for status in partitions),
+            paused=[machine.machine_partition for machine in self.partitions
+                    if machine.paused],
+            stats=stats.as_dict(),
+            partitions=partitions,
+        )
+
+
+# The machines which have been subscribed to the CherryPy engine - see
+# registered_machines.
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def register_machine(machine):
+    """Adds the machine to those reported on by MetricsPage. This is done
+    automatically by Machine.subscribe."""
+    with _registry_lock:
+        if machine not in _registry:
+            _registry.append(machine)
+
+
+def unregister_machine(machine):
+    """Removes a machine added by register_machine."""
+    with _registry_lock:
+        if machine in _registry:
+            _registry.remove(machine)
+
+
+def registered_machines():
+    """Returns a list of the machines which have been registered."""
+    with _registry_lock:
+        return list(_registry)
+
+
+def stop_machines(machines=None, timeout=None):
+    """Stops the given machines (or all registered machines) at the same
+    time, and waits for them to finish - taking no more than timeout
+    seconds in total, if given.
+
+    Returns a list of the machines which are still running."""
+    if machines is None:
+        machines = registered_machines()
+
+    threads = []
+    for machine in machines:
+        thread = machine.machine_thread
+        machine.stop()  # This will clear the reference to the thread.
+        if thread is not None:
+            threads.append((machine, thread))
+
+    deadline = None if timeout is None else _monotonic() + timeout
+    running = []
+    for machine, thread in threads:
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(deadline - _monotonic(), 0))
+        if thread.is_alive():
+            running.append(machine)
+    return running
+
+
+# Set by install_shutdown_handler.
+_shutdown_timeout = None
+_shutdown_handler_installed = False
+
+
+def install_shutdown_handler(timeout=None):
+    """Integrates with CherryPy's signal handling mechanism so that when
+    SIGTERM is received, all registered machines are stopped at the same
+    time, and the rest of the web service is only shut down once they
+    have finished (or once timeout seconds have passed, if given).
+
+    This may be called more than once (it is called by each machine's
+    override_signal_handler) - a timeout replaces any given before, but
+    calling it without one leaves an earlier timeout in place.
+
+    Returns true if it was installed successfully.
+    """
+    global _shutdown_timeout, _shutdown_handler_installed
+    import cherrypy
+    try:
+        handler = cherrypy.engine.signal_handler
+    except AttributeError:
+        return False
+
+    with _registry_lock:
+        if timeout is not None:
+            _shutdown_timeout = timeout
+        if _shutdown_handler_installed:
+            return True
+        _shutdown_handler_installed = True
+
+    old_sigterm_handler = handler.handlers['SIGTERM']
+
+    def delayed_stop():
+        # We don't want multiple signals to cause this service to halt.
+        # We trust that after the machines have finished, we will pass
+        # on the signal. We won't allow any other signals to make their
+        # way through.
+        handler.handlers['SIGTERM'] = lambda: None
+
+        machines = registered_machines()
+        _log('Waiting for %d machines to stop before shutting down.',
+             len(machines))
+        for machine in stop_machines(machines, _shutdown_timeout):
+            _log('%s has not stopped - shutting down anyway.',
+                 machine.machine_name)
+
+        # Shut down everything else.
+        old_sigterm_handler()
+
+    handler.handlers['SIGTERM'] = delayed_stop
+    handler.subscribe()
+    return True
+
+
+def run_machines(machines, timeout=None):
+    """Runs the given machines without CherryPy - this starts them, and
+    blocks until SIGTERM or SIGINT is received (or until all of them have
+    stopped or failed by themselves). The machines are then stopped at
+    the same time (see stop_machines), taking no more than timeout
+    seconds in total, if given.
+
+    This must be called from the main thread. Returns a list of the
+    machines which are still running."""
+    received = threading.Event()
+
+    def on_signal(signum, frame):  # pylint: disable=unused-argument
+        received.set()
+
+    previous = {}
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous[signum] = signal.signal(signum, on_signal)
+
+    try:
+        for machine in machines:
+            register_machine(machine)
+            machine.start()
+
+        # Waiting with a timeout lets signal handlers run on Python 2.
+        while not received.wait(0.5):
+            if not any(m.machine_thread is not None and
+                       m.machine_thread.is_alive() for m in machines):
+                break
+
+        if received.is_set():
+            _log('Signal received: stopping %d machines.', len(machines))
+        running = stop_machines(machines, timeout)
+        for machine in running:
+            _log('%s has not stopped.', machine.machine_name)
+        return running
+    finally:
+        for machine in machines:
+            unregister_machine(machine)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def _metric_label(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def render_metrics(machines=None):
+    """Returns a description of the machines (or the registered machines
+    if not given) in the Prometheus text exposition format.
+
+    This only reads counters which the machines maintain as they go, so
+    it doesn't need to look at run histories or wait for machines to
+    finish what they're doing."""
+    if machines is None:
+        machines = registered_machines()
+
+    # The histogram only reports every doubling of duration - the finer
+    # buckets are added together.
+    step = RunStats.BUCKETS_PER_DOUBLING
+    bounds = [(i, '%g' % RunStats.bucket_bound(i))
+              for i in range(0, RunStats.BUCKET_COUNT - 1, step)]
+    states = [BoneMachine.RUNNING, BoneMachine.PAUSED, BoneMachine.WAITING,
+              BoneMachine.STOPPING, BoneMachine.STOPPED, BoneMachine.FAILED,
+              BoneMachine.STANDBY]
+    now = _monotonic()
+
+    sections = [
+        ('machinerry_runs_total', 'counter', 'Runs performed.'),
+        ('machinerry_run_failures_total', 'counter', 'Runs which failed.'),
+        ('machinerry_run_duration_seconds', 'histogram', 'Duration of runs.'),
+        ('machinerry_state', 'gauge', 'Current state of the machine.'),
+        ('machinerry_pauses_total', 'counter', 'Times the machine has paused.'),
+        ('machinerry_pause_seconds_total', 'counter', 'Time spent paused.'),
+    ]
+    lines = {name: ['# HELP %s %s' % (name, text), '# TYPE %s %s' % (name, kind)]
+             for name, kind, text in sections}
+
+    for machine in machines:
+        label = 'machine="%s"' % _metric_label(machine.machine_name)
+        stats = machine.machine_stats
+        buckets = list(stats.buckets)
+        count = sum(buckets)
+
+        lines['machinerry_runs_total'].append(
+            'machinerry_runs_total{%s} %d' % (label, stats.count))
+        lines['machinerry_run_failures_total'].append(
+            'machinerry_run_failures_total{%s} %d' % (label, stats.failures))
+
+        hist = lines['machinerry_run_duration_seconds']
+        cumulative, upto = 0, 0
+        for index, bound in bounds:
+            cumulative += sum(buckets[upto:index + 1])
+            upto = index + 1
+            hist.append('machinerry_run_duration_seconds_bucket{%s,le="%s"} %d'
+                        % (label, bound, cumulative))
+        hist.append('machinerry_run_duration_seconds_bucket{%s,le="+Inf"} %d'
+                    % (label, count))
+        hist.append('machinerry_run_duration_seconds_sum{%s} %r'
+                    % (label, stats.duration_total))
+        hist.append('machinerry_run_duration_seconds_count{%s} %d'
+                    % (label, count))
+
+        state = machine.machine_state
+        lines['machinerry_state'].extend(
+            'machinerry_state{%s,state="%s"} %d' % (label, each, each == state)
+            for each in states)
+
+        paused_since = machine._machine_paused_since
+        pause_seconds = machine.machine_pause_seconds
+        if paused_since is not None:
+            pause_seconds += now - paused_since
+        lines['machinerry_pauses_total'].append(
+            'machinerry_pauses_total{%s} %d' % (label, machine.machine_pause_count))
+        lines['machinerry_pause_seconds_total'].append(
+            'machinerry_pause_seconds_total{%s} %r' % (label, pause_seconds))
+
+    return ''.join(
+        '\n'.join(lines[name]) + '\n' for name, _, _ in sections)
+
+
+class MetricsPage(object):
+
+    """A CherryPy handler which reports on the registered machines in
+    the Prometheus text exposition format.
+
+    >>> cherrypy.tree.mount(MetricsPage(), '/metrics')  # doctest: +SKIP
+    """
+
+    def index(self):
+        import cherrypy
+        cherrypy.response.headers['Content-Type'] = \
+            'text/plain; version=0.0.4; charset=utf-8'
+        return render_metrics()
+    index.exposed = True
+
+
+# A status alert generated by a machine - see StatusNotifier.
+StatusAlert = collections.namedtuple('StatusAlert', [
+    'machine_name', 'state', 'lines',
+])
+
+
+class FileTransport(object):
+
+    """Transport for StatusNotifier which appends messages to a file -
+    useful for testing, or for having something else pick them up."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, subject, body):
+        with open(self.path, 'a') as f:
+            f.write('Subject: %s\n\n%s\n\n' % (subject, body))
+
+
+class SMTPTransport(object):
+
+    """Transport for StatusNotifier which sends messages as e-mails."""
+
+    def __init__(self, sender, recipients, host='localhost', port=25,
+                 timeout=30):
+        self.sender = sender
+        self.recipients = list(recipients)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def send(self, subject, body):
+        import smtplib
+        from email.mime.text import MIMEText
+
+        msg = MIMEText(body)
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = ', '.join(self.recipients)
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.sendmail(self.sender, self.recipients, msg.as_string())
+        finally:
+            smtp.quit()
+
+
+class StatusNotifier(object):
+
+    """Sends status alerts generated by machines in a background thread,
+    so that machines aren't held up by delivering them.
+
+    >>> notifier = StatusNotifier(SMTPTransport('me@x.com', ['you@x.com']))
+    >>> MyMachine.status_notifier = notifier  # doctest: +SKIP
+
+    Alerts are collected for window seconds after the first one arrives,
+    and are then sent together in a single message by the transport (an
+    object with a send(subject, body) method). If a machine generates
+    more than one alert in that time, only the latest one is included.
+    If the transport fails, it is retried up to retries more times,
+    with retry_delay seconds between each attempt.
+    """
+
+    def __init__(self, transport, window=30, retries=3, retry_delay=10):
+        self.transport = transport
+        self.window = window
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._flushing = False
+        self._thread = None
+
+    def notify(self, machine_name, state, lines):
+        """Queues an alert to be sent - this doesn't wait for it to be
+        delivered."""
+        with self._cond:
+            prev = self._pending.pop(machine_name, None)
+            count = 1 if prev is None else prev[1] + 1
+            self._pending[machine_name] = (
+                StatusAlert(machine_name, state, list(lines)), count)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.name = 'machinerry status notifier'
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        """Sends any queued alerts without waiting for the rest of the
+        window to elapse, and waits (up to timeout seconds) for them to
+        be delivered."""
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._flushing = True
+            self._cond.notify()
+        thread.join(timeout)
+
+    def format_digest(self, alerts):
+        """Returns the subject and body of the message to send for the
+        given list of (alert, count) pairs."""
+        if len(alerts) == 1:
+            subject = '%s %s' % (alerts[0][0].machine_name, alerts[0][0].state)
+        else:
+            subject = 'Status of %d machines' % len(alerts)
+
+        parts = []
+        for alert, count in alerts:
+            header = '%s: %s' % (alert.machine_name, alert.state)
+            if count > 1:
+                header += ' (latest of %d alerts)' % count
+            parts.append('\n'.join([header] + alert.lines))
+        return subject, '\n\n'.join(parts)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._flushing:
+                    self._cond.wait()
+
+                # Give other alerts a chance to arrive.
+                deadline = _monotonic() + self.window
+                while not self._flushing:
+                    remaining = deadline - _monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                alerts = list(self._pending.values())
+                self._pending.clear()
+                if self._flushing:
+                    self._flushing = False
+                    self._thread = None
+
+            if alerts:
+                self._deliver(alerts)
+            if self._thread is not threading.current_thread():
+                return
+
+    def _deliver(self, alerts):
+        subject, body = self.format_digest(alerts)
+        for attempt in range(self.retries + 1):
+            # noinspection PyBroadException
+            try:
+                self.transport.send(subject, body)
+                return
+            except Exception:  # pylint: disable=broad-except
+                _log('Unable to send status alert (attempt %d).',
+                     attempt + 1, traceback=True)
+            if attempt < self.retries:
+                time.sleep(self.retry_delay)
+
+
+# Handle returned by MachineScheduler.schedule - it mimics the parts of
+# the Thread interface which get used on machine_thread.
+class _ScheduledMachine(object):
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.name = '%s (scheduled)' % machine.machine_name
+        self.started = False
+        self.busy = False
+        self.seq = None
+
+        # When the machine was due to be handed to a worker, and whether
+        # that was because a wait had elapsed (rather than because it
+        # was woken up).
+        self.due = None
+        self.timed = False
+        self.done = threading.Event()
+
+        # If the machine is started again before this entry has finished
+        # shutting it down, the entry which takes over afterwards.
+        self.successor = None
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+
+class MachineScheduler(object):
+
+    """Runs any number of machines using a single timer thread and a
+    bounded pool of worker threads, rather than a thread per machine.
+
+    The timer thread keeps a heap of when each machine next needs to
+    wake up (based on its run_time_next or pause_until), and hands
+    due machines to the worker pool. Interrupting a machine (which is
+    also done by run_now and by changing the pause state) wakes it up
+    immediately, just as it would with a dedicated thread.
+
+    >>> scheduler = MachineScheduler(max_workers=8)
+    >>> m = MyMachine('test')  # doctest: +SKIP
+    >>> m.machine_scheduler = scheduler  # doctest: +SKIP
+    >>> m.start()  # doctest: +SKIP
+
+    A single machine is only ever worked on by one worker at a time. As
+    the pool is bounded, a machine whose execute method takes a long
+    time to finish will occupy a worker for that long - so size
+    max_workers according to how many machines you expect to be
+    running at once.
+    """
+
+    def __init__(self, max_workers=4, name='machine scheduler'):
+        if futures is None:
+            raise RuntimeError('MachineScheduler requires concurrent.futures')
+        self.name = name
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._thread = None
+        self._pool = None
+
+        # How late machines have been in being handed to a worker after
+        # they were due (in seconds).
+        self.dispatch_lag = RollingStats()
+
+    @property
+    def machines(self):
+        """The machines currently registered with the scheduler."""
+        with self._cond:
+            return [e.machine for e in self._entries.values()]
+
+    def schedule(self, machine):
+        """Start running the given machine on the scheduler. This is
+        invoked by the start method of a machine whose machine_scheduler
+        attribute is set, so you wouldn't normally need to call this
+        yourself.
+
+        Returns a handle which can be joined to wait for the machine
+        to stop."""
+        with self._cond:
+            entry = self._entries.get(id(machine))
+            if entry is None:
+                entry = self._entries[id(machine)] = _ScheduledMachine(machine)
+                self._push(entry, 0)
+            elif entry.started:
+                # The machine has been stopped, but the existing entry
+                # hasn't finished shutting it down yet - a fresh one takes
+                # over once it has.
+                if entry.successor is None:
+                    entry.successor = _ScheduledMachine(machine)
+                entry = entry.successor
+            if self._thread is None:
+                self._pool = futures.ThreadPoolExecutor(self.max_workers)
+                self._thread = threading.Thread(target=self._run)
+                self._thread.name = '%s thread' % self.name
+                self._thread.daemon = True
+                self._thread.start()
+            return entry
+
+    def wake(self, machine):
+        """Make the machine perform its next loop iteration as soon as
+        possible. This is invoked by the interrupt method of a machine."""
+        with self._cond:
+            entry = self._entries.get(id(machine))
+
+            # If a worker is currently handling the machine, it will
+            # check the machine's event flag once it has finished.
+            if entry is not None and not entry.busy:
+                self._push(entry, 0)
+
+    def status(self):
+        """Returns a dictionary describing the scheduler, including how
+        late machines have recently been in getting a worker."""
+        with self._cond:
+            machines = len(self._entries)
+        return dict(
+            machines=machines,
+            workers=self.max_workers,
+            lag=self.dispatch_lag.as_dict(),
+        )
+
+    def stop(self, timeout=None):
+        """Stop all the machines on the scheduler, wait (up to timeout
+        seconds) for them to finish, and then stop the scheduler's own
+        threads."""
+        with self._cond:
+            entries = list(self._entries.values())
+        for entry in entries:
+            entry.machine.stop()
+
+        deadline = None if timeout is None else _monotonic() + timeout
+        for entry in entries:
+            if deadline is None:
+                entry.join()
+            else:
+                entry.join(max(deadline - _monotonic(), 0))
+
+        with self._cond:
+            thread, pool = self._thread, self._pool
+            self._thread = self._pool = None
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+            pool.shutdown(wait=False)
+
+    # Must be called with the lock held.
+    def _push(self, entry, wait):
+        if wait is None:
+            entry.seq = None
+            return
+
+        entry.seq = seq = next(self._counter)
+        entry.timed = wait > 0
+        heapq.heappush(self._heap, (_monotonic() + wait, seq, entry))
+
+        # Entries which have been superseded are left in the heap until
+        # they reach the top - but if machines are woken up often, we
+        # don't want them accumulating.
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = [i for i in self._heap if i[2].seq == i[1]]
+            heapq.heapify(self._heap)
+
+        self._cond.notify()
+
+    def _run(self):
+        me = threading.current_thread()
+        with self._cond:
+            while self._thread is me:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                due, seq, entry = self._heap[0]
+                if seq != entry.seq:
+                    heapq.heappop(self._heap)
+                    continue
+
+                delay = due - _monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                entry.seq = None
+                entry.due = due
+                entry.busy = True
+                self._pool.submit(self._step, entry)
+
+    # Performs the equivalent of one pass of BoneMachine.run's loop.
+    def _step(self, entry):
+        machine = entry.machine
+        finished, wait = True, 0
+        lag = _monotonic() - entry.due
+        self.dispatch_lag.add(lag)
+        if entry.timed:
+            machine.machine_wakeup_lag.add(lag)
+        try:
+            machine.machine_event_flag.clear()
+            machine.machine_threadid = _get_ident()
+            if not entry.started:
+                entry.started = True
+                machine._machine_startup()
+
+            if machine.machine_is_running:
+                wait = machine._machine_step()
+                finished = False
+            else:
+                machine._machine_shutdown()
+
+        except Exception as e:  # pylint: disable=broad-except
+            machine._machine_failed(e)
+
+        finally:
+            with self._cond:
+                entry.busy = False
+                if finished:
+                    if entry.successor is None:
+                        del self._entries[id(machine)]
+                    else:
+                        self._entries[id(machine)] = entry.successor
+                        self._push(entry.successor, 0)
+                    entry.done.set()
+                else:
+                    if machine.machine_event_flag.is_set():
+                        wait = 0
+                    self._push(entry, wait)
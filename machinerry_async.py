@@ -0,0 +1,248 @@
+"""asyncio support for machinerry - this lives in a module of its own
+as it requires Python 3.7 or later."""
+
+import asyncio
+import contextvars
+import functools
+import threading
+
+from machinerry import BrokenProcessPool, Machine, RunCancelled, \
+    _discard_process_pool, _get_ident, get_process_pool
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+# Replacement for the threading.local used to record which run is being
+# performed - machines on the same event loop share a thread, so we use
+# the context of the task performing the run instead.
+class _TaskLocal(object):
+
+    def __init__(self):
+        self._run = contextvars.ContextVar('run', default=None)
+
+    @property
+    def run(self):
+        return self._run.get()
+
+    @run.setter
+    def run(self, run):
+        self._run.set(run)
+
+
+# Handle used as the machine_thread of an AsyncMachine - it mimics the
+# parts of the Thread interface which get used on machine_thread.
+#
+# Note that join will block the calling thread, so it shouldn't be used
+# from the thread running the event loop.
+class _MachineTask(object):
+
+    def __init__(self, machine, future):
+        self.name = '%s task' % machine.machine_name
+        self.future = future
+        self.done = threading.Event()
+        future.add_done_callback(lambda f: self.done.set())
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+
+# noinspection PyAbstractClass
+class AsyncMachine(Machine):
+
+    """A machine which runs as a task on an asyncio event loop, rather
+    than in a thread of its own. Any number of machines can share the
+    same event loop.
+
+    Subclasses define execute as a coroutine:
+
+    >>> class MyMachine(AsyncMachine):
+    ...    async def execute(self):
+    ...        await foo()
+    >>> m = MyMachine('test')
+    >>> m.subscribe()  # doctest: +SKIP
+
+    Otherwise, it behaves in the same way as Machine - the hooks are
+    invoked in the same way (as normal functions, on the event loop), and
+    pausing, resuming and scheduling all work as they do when a machine
+    has a thread of its own. The methods which perform runs (run,
+    run_once and run_in_process) are coroutines.
+
+    If max_concurrent_runs is set, overlapping runs are performed as
+    separate tasks on the event loop rather than in a pool of threads.
+
+    The wait method of a run's cancellation token would block the event
+    loop, so execute should check its cancelled attribute instead.
+    """
+
+    # The event loop to run the machine on. If this isn't set when the
+    # machine is started, it will be set to the running event loop.
+    machine_loop = None
+
+    def __init__(self, name):
+        super(AsyncMachine, self).__init__(name)
+        self._machine_local = _TaskLocal()
+        self._machine_async_event = None
+        self._machine_tasks = set()
+
+    def _launch(self):
+        running = _running_loop()
+        if self.machine_loop is None:
+            if running is None:
+                raise RuntimeError(
+                    'no event loop to run %s on - set machine_loop '
+                    'before starting it' % self.machine_name)
+            self.machine_loop = running
+
+        if self.machine_loop is running:
+            future = running.create_task(self.run())
+        else:
+            future = asyncio.run_coroutine_threadsafe(
+                self.run(), self.machine_loop)
+        return _MachineTask(self, future)
+
+    def interrupt(self):
+        '''Tell the machine to wake up. This can be called from any
+        thread.'''
+        super(AsyncMachine, self).interrupt()
+        event, loop = self._machine_async_event, self.machine_loop
+        if event is None or loop.is_closed():
+            return
+        if _running_loop() is loop:
+            event.set()
+        else:
+            loop.call_soon_threadsafe(event.set)
+
+    async def run(self):
+        """Continuously run self.execute(). Errors are trapped and logged."""
+        try:
+            self.machine_threadid = _get_ident()
+            self._machine_async_event = asyncio.Event()
+            self._machine_startup()
+
+            while self.machine_is_running:
+                self._machine_async_event.clear()
+                wait = await self._machine_step()
+                if wait is None or wait > 0:
+                    await self._machine_sleep(wait)
+
+            await self._machine_shutdown()
+
+        except Exception as e:
+            self._machine_failed(e)
+            raise
+
+    async def _machine_step(self):
+        wait = self._machine_poll()
+        if wait is not self._RUN_DUE:
+            return wait
+
+        self.machine_state = self.RUNNING
+        if self.max_concurrent_runs > 1:
+            return self._dispatch_run()
+        await self.run_once()
+        return 0
+
+    def _dispatch_run(self):
+        # We'll be interrupted when one of the runs completes.
+        if len(self.machine_runs_in_flight) >= self.max_concurrent_runs:
+            return None
+
+        run = self._begin_run()
+        self._reschedule_overlapping(run)
+        task = self.machine_loop.create_task(self._perform_run(run))
+        self._machine_tasks.add(task)
+        task.add_done_callback(self._machine_tasks.discard)
+        return 0
+
+    async def _machine_shutdown(self):
+        # Let any runs which are still in progress finish.
+        if self._machine_tasks:
+            await asyncio.wait(list(self._machine_tasks))
+        super(AsyncMachine, self)._machine_shutdown()
+
+    # Sleeps for the given number of seconds (or until interrupted if
+    # None), waking up early if the machine is interrupted.
+    async def _machine_sleep(self, wait):
+        event = self._machine_async_event
+        loop = self.machine_loop
+        slept_from = loop.time()
+        handle = None
+        if wait is not None:
+            handle = loop.call_at(slept_from + wait, event.set)
+        try:
+            await event.wait()
+        finally:
+            if handle is not None:
+                handle.cancel()
+
+        # Record how much we overslept by, if we weren't interrupted.
+        slept = loop.time() - slept_from
+        if wait is not None and slept >= wait:
+            self.machine_wakeup_lag.add(slept - wait)
+
+    async def _wait_until(self, dtime):
+        await self._machine_sleep(self._how_long_until(dtime))
+
+    async def run_in_process(self, func, *args, **kwargs):
+        """Invokes func with the given arguments in the process pool
+        shared between machines (see get_process_pool), and waits for
+        the result without blocking the event loop. Any exception raised
+        by func will be raised here."""
+        pool = get_process_pool()
+        call = functools.partial(func, *args, **kwargs)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, call)
+        except BrokenProcessPool:
+            # A worker process died - discard the pool so the next run
+            # gets a working one.
+            _discard_process_pool(pool)
+            raise
+
+    async def run_once(self):
+        """Run self.execute() once. Errors are trapped.
+
+        This is the equivalent of performing a single run immediately in
+        the context of the machine (with regard to all the prep work which
+        takes place around it). You should not do this while the machine
+        is running."""
+        return await self._perform_run(self._begin_run())
+
+    async def _perform_run(self, run):
+        self._machine_local.run = run
+        run.thread_id = _get_ident()
+        run._paused_by_execute = False
+        res = None
+
+        try:
+            res = await self.execute()
+            if self.execute_in_process and callable(res):
+                res = await self.run_in_process(res)
+        except asyncio.CancelledError:
+            self._abort_run(run)
+            raise
+        except (KeyboardInterrupt, SystemExit):
+            self._abort_run(run)
+            self._shut_down_engine()
+            raise
+        except RunCancelled:
+            run.cancelled = True
+            self._finish_run(run, None)
+        except Exception as e:
+            self._finish_run(run, e)
+        else:
+            self._finish_run(run, None)
+        return res
+
+    async def execute(self):
+        """Main block of code to execute in a run. Subclasses must define
+        this as a coroutine."""
+        raise NotImplementedError
@@ -4,6 +4,8 @@
 # Extract the project identity from the README.
 #
 import io
+import sys
+
 import setuptools
 
 with io.open('README.rst', encoding='utf-8') as readme:
@@ -30,6 +32,11 @@ name = get_definition('.. |name| replace:: ')
 # End extraction code.
 #
 
+# machinerry_async uses syntax which only Python 3.7 onwards supports.
+py_modules = ['machinerry']
+if sys.version_info >= (3, 7):
+    py_modules.append('machinerry_async')
+
 params = dict(
     name=name,
     use_scm_version=True,
@@ -40,17 +47,19 @@ params = dict(
     license='MIT',
     url=get_definition('.. _repository: '),
     keywords=[],
-    py_modules=['machinerry'],
+    py_modules=py_modules,
     include_package_data=True,
     namespace_packages=name.split('.')[:-1],
     python_requires='>=2.7',
     install_requires=[
-        'CherryPy',
-        'requests',
-        'six',
+        'futures; python_version<"3"',
     ],
     extras_require={
+        'cherrypy': [
+            'CherryPy',
+        ],
         'testing': [
+            'CherryPy',
             'pytest>=3.5',
             'pytest-sugar>=0.9.1',
             'collective.checkdocs',
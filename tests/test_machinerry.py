@@ -2,15 +2,30 @@ from __future__ import print_function
 from decimal import Decimal, ROUND_HALF_DOWN
 from datetime import timedelta
 try:
-    from queue import Queue, Empty
+    from queue import Queue, Empty, Full
 except ImportError:
-	from Queue import Queue, Empty # python 2
+	from Queue import Queue, Empty, Full # python 2
+import functools
 import logging
+import operator
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 import cherrypy
+import pytest
 
-from machinerry import Machine
+import machinerry
+from machinerry import Machine, MachineScheduler, MetricsPage, RunStats, \
+    Backpressure, FileLease, FileTransport, FileWatchMachine, \
+    PartitionedMachine, PriorityQueueMachine, QueueMachine, SQLiteLease, \
+    StatusNotifier, disable_queued_logging, enable_queued_logging, \
+    registered_machines, run_machines, set_process_pool, stop_machines
 
 
 class LogToList(logging.Handler):
@@ -49,6 +64,9 @@ class MachineForTesting(Machine):
     def record(self, name, value):
         self.job_queue.put(('record', name, value))
 
+    def snooze(self, secs):
+        self.job_queue.put(('snooze', secs))
+
     def pauseit(self, message, how_long, repeat):
         self.job_queue.put(('pause', message, how_long, repeat))
 
@@ -65,6 +83,10 @@ class MachineForTesting(Machine):
     def perform_delay(self, secs):
         time.sleep(secs)
 
+    def perform_snooze(self, secs):
+        self.machine_run.token.wait(secs)
+        self.machine_run.token.raise_if_cancelled()
+
     def perform_echo(self, message):
         self.message_log.append(message)
 
@@ -102,6 +124,43 @@ class MachineForTesting(Machine):
             self.resume_by(None)
 
 
+class QueueMachineForTesting(QueueMachine):
+
+    def __init__(self, name):
+        QueueMachine.__init__(self, name)
+        self.batches = []
+
+    def execute_batch(self, items):
+        if 'fail' in items:
+            raise RuntimeError('Bankai!')
+        self.batches.append(items)
+
+
+class PriorityQueueMachineForTesting(PriorityQueueMachine):
+
+    def __init__(self, name):
+        PriorityQueueMachine.__init__(self, name)
+        self.batches = []
+        self.expired = []
+
+    def execute_batch(self, jobs):
+        self.batches.append([job.item for job in jobs])
+
+    def on_machine_job_expired(self, job):
+        self.expired.append(job.item)
+
+
+class FileWatchMachineForTesting(FileWatchMachine):
+
+    def __init__(self, name, path):
+        FileWatchMachine.__init__(self, name)
+        self.watch_path = path
+        self.changes = []
+
+    def execute_changes(self, paths):
+        self.changes.append([os.path.basename(p) for p in paths])
+
+
 class TestMachine(object):
     
     def assertEqual(self, x, y):
@@ -500,13 +559,13 @@ class TestMachine(object):
         # Start off with no record history.
         self.machine.wait_run_frequency = 10
         self.machine.run_history_limit = None
-        self.assertEqual(self.runs, [])
+        self.assertRunHistorySize(0)
 
         # First test - no limit means no run information gets saved.
         self.machine.record('hueco', 'mundo')
         self.machine.start()
         self.wait(0.5)
-        self.assertEqual(self.runs, [])
+        self.assertRunHistorySize(0)
 
         # Second test - a limit will mean record information gets saved.
         self.machine.run_history_limit = 2
@@ -658,3 +717,933 @@ class TestMachine(object):
 
         # Also hopefully a message in the logs.
         self.assertPrinted('%s failed.' % self.machine.machine_name)
+
+    def test_machine_runs_on_shared_scheduler(self):
+        scheduler = MachineScheduler(max_workers=2)
+        machines = [MachineForTesting('sched_%d' % i) for i in range(10)]
+        threads_before = threading.active_count()
+        try:
+            for m in machines:
+                m.machine_scheduler = scheduler
+                m.wait_run_frequency = 10
+                m.echo('Byakuya %s' % m.machine_name)
+                m.start()
+            self.wait(0.5)
+
+            # Only the timer thread and the workers should have been
+            # created, regardless of how many machines there are.
+            assert threading.active_count() - threads_before <= 3
+            for m in machines:
+                assert m.machine_state == 'WAITING'
+                assert 'Byakuya %s' % m.machine_name in m.message_log
+
+            # run_now should wake the machine up well before its next
+            # scheduled run.
+            m = machines[0]
+            m.echo('Renji')
+            m.run_now()
+            self.wait(0.5)
+            assert 'Renji' in m.message_log
+
+            # Pausing and resuming should behave as it does on a thread.
+            m.paused = True
+            self.wait(0.5)
+            assert m.machine_state == 'PAUSED'
+            m.paused = False
+            self.wait(0.5)
+            assert m.machine_state == 'WAITING'
+
+            # The scheduler keeps track of how late it has been in
+            # handing machines to workers.
+            status = scheduler.status()
+            self.assertEqual(status['machines'], 10)
+            assert status['lag']['count'] > 0
+
+            # Stopping and straight away restarting a machine leaves it
+            # running (though paused, as stopping it pauses it).
+            m.stop()
+            m.start()
+            self.wait(0.5)
+            assert m.machine_thread.is_alive()
+            m.paused = False
+            self.wait(0.5)
+            assert m.machine_state == 'WAITING'
+            m.echo('Rukia')
+            m.run_now()
+            self.wait(0.5)
+            assert 'Rukia' in m.message_log
+        finally:
+            scheduler.stop(timeout=5)
+
+        for m in machines:
+            assert m.machine_state == 'STOPPED'
+
+    def test_machine_overlapping_runs(self):
+        self.machine.max_concurrent_runs = 3
+        self.machine.run_history_limit = 0
+        for i in range(3):
+            self.machine.delay(1)
+        for name in ('ichigo', 'rukia'):
+            self.machine.record('shinigami', name)
+        self.machine.start()
+
+        # Each slow run should have been started without waiting for
+        # the previous one to finish.
+        self.wait(0.6)
+        self.assertState('RUNNING')
+        self.assertEqual(len(self.machine.machine_runs_in_flight), 3)
+
+        # And while they're all busy, no more runs get started.
+        self.assertRunHistorySize(3)
+
+        # Once they've finished, the other runs should record data
+        # against their own run objects.
+        self.wait(1.5)
+        self.assertEqual(self.machine.machine_runs_in_flight, [])
+        self.assertEqual(self.runs[3].shinigami, 'ichigo')
+        self.assertEqual(self.runs[4].shinigami, 'rukia')
+
+    def test_machine_execute_in_process(self):
+        self.machine.execute_in_process = True
+        self.machine.run_history_limit = 0
+
+        # A callable returned by execute gets invoked in another process.
+        self.machine.execute = lambda: os.getpid
+        pid = self.machine.run_once()
+        assert pid != os.getpid()
+        assert not self.runs[-1].failed
+
+        # And errors raised over there are handled as they would be if
+        # they were raised by execute.
+        self.machine.pause_on_error = True
+        self.machine.execute = lambda: functools.partial(operator.truediv, 1, 0)
+        self.machine.run_once()
+        assert self.runs[-1].failed
+        assert self.machine.paused
+        self.assertPrinted('ZeroDivisionError')
+
+    def test_machine_run_in_custom_pool(self):
+        futures = pytest.importorskip('concurrent.futures')
+        pool = futures.ThreadPoolExecutor(1)
+        set_process_pool(pool)
+        try:
+            # Errors from the job should come through as they are, even
+            # though the pool isn't a process pool.
+            with pytest.raises(ZeroDivisionError):
+                self.machine.run_in_process(operator.truediv, 1, 0)
+            self.assertEqual(self.machine.run_in_process(operator.add, 1, 2), 3)
+        finally:
+            set_process_pool(None)
+            pool.shutdown()
+
+    def test_machine_wait_calculation(self):
+        now = self.machine.now()
+
+        # Waits longer than a day shouldn't be truncated, and times in
+        # the past shouldn't turn into long waits.
+        wait = self.machine._how_long_until(now + timedelta(days=2))
+        assert 172799 < wait <= 172800
+        self.assertEqual(self.machine._how_long_until(now - timedelta(seconds=5)), 0)
+
+    def test_machine_fixed_rate_catch_up(self):
+        self.machine.wait_run_frequency = 1
+        self.machine.run_history_limit = 0
+
+        # A run which was due some time ago - the next run should be
+        # based on when it was due, not when it actually started.
+        for policy, expected_gap in [('burst', 1), ('coalesce', 3), ('skip', 4)]:
+            self.machine.wait_catch_up = policy
+            due = self.machine.now() - timedelta(seconds=3.5)
+            self.machine.run_time_next = due
+            self.machine.run_once()
+            self.assertEqual(self.runs[-1].time_planned, due)
+            self.assertEqual(self.machine.run_time_next - due,
+                             timedelta(seconds=expected_gap))
+
+    def test_machine_start_spread(self):
+        offsets = []
+        for name in ['Ichigo', 'Rukia', 'Renji', 'Ichigo']:
+            machine = MachineForTesting(name)
+            machine.start_spread = 60
+            offsets.append(machine.start_offset())
+
+        # Offsets are derived from the name, so they are spread across
+        # the window, but the same for a given machine.
+        assert all(0 < offset < 60 for offset in offsets)
+        self.assertEqual(len(set(offsets)), 3)
+        self.assertEqual(offsets[0], offsets[3])
+
+        machine.start_spread_random = True
+        assert 0 <= machine.start_offset() <= 60
+
+    def test_machine_wait_jitter(self):
+        self.machine.wait_run_frequency = 10
+        self.machine.wait_jitter = 2
+        self.machine.run_history_limit = 0
+
+        due = self.machine.now()
+        self.machine.run_time_next = due
+        for i in range(5):
+            self.machine.run_once()
+            gap = (self.machine.run_time_next - due).total_seconds()
+
+            # Each run is delayed by some jitter, but that doesn't get
+            # added to the jitter of the runs after it.
+            assert 0 <= gap - 10 * (i + 1) <= 2
+
+        self.assertEqual(self.runs[0].jitter, 0)
+        assert all(0 <= r.jitter <= 2 for r in list(self.runs)[1:])
+
+    def test_machine_run_history_is_bounded(self):
+        self.machine.run_history_limit = 3
+        for i in range(10):
+            self.machine.run_once()
+
+        # Only the most recent runs are kept, without needing to copy the
+        # history each time.
+        self.assertEqual([r.id for r in self.runs], [7, 8, 9])
+        self.assertEqual(self.runs.maxlen, 3)
+
+        # Runs still allow any extra information to be stored on them.
+        self.runs[-1].zanpakuto = 'Zangetsu'
+        self.assertEqual(self.runs[-1].zanpakuto, 'Zangetsu')
+
+    def test_machine_run_stats(self):
+        self.machine.delay(0.1)
+        self.machine.fail('Getsuga Tensho')
+        self.machine.run_once()
+        self.machine.run_once()
+        self.machine.run_once()
+
+        stats = self.machine.status()['stats']
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['failures'], 1)
+        assert 0.1 <= stats['max'] < 0.2
+        assert stats['p50'] < 0.1 <= stats['p99']
+
+    def test_run_stats_percentiles(self):
+        stats = RunStats()
+        for ms in range(1, 101):
+            stats.record(ms / 1000.0, failed=(ms % 10 == 0))
+
+        self.assertEqual(stats.failures, 10)
+        assert abs(stats.as_dict()['mean'] - 0.0505) < 1e-9
+        for pct in (50, 95, 99):
+            estimate = stats.percentile(pct)
+            assert pct / 1000.0 <= estimate <= pct / 1000.0 * 1.19
+        self.assertEqual(stats.percentile(100), 0.1)
+
+    def test_machine_records_lag(self):
+        self.machine.wait_min = 0.1
+        self.machine.run_history_limit = 0
+        self.machine.start()
+        self.wait(0.5)
+
+        # Each run records how late it started compared to when it was
+        # due, and the machine keeps track of how late it woke up.
+        run = self.runs[-1]
+        self.assertEqual(run.lag, (run.time_start - run.time_planned).total_seconds())
+        lag = self.machine.status()['lag']
+        assert lag['start']['count'] == len(self.runs)
+        assert lag['wakeup']['count'] > 0
+        assert 0 <= lag['wakeup']['max'] < 0.1
+
+    def test_machine_metrics(self):
+        self.machine.subscribe()
+        try:
+            assert self.machine in registered_machines()
+            self.machine.fail('Senbonzakura')
+            self.machine.run_once()
+            self.machine.run_once()
+            self.machine.paused = True
+            self.machine._become_paused(True)
+
+            name = self.machine.machine_name
+            text = MetricsPage().index()
+            lines = text.splitlines()
+            assert 'machinerry_runs_total{machine="%s"} 2' % name in lines
+            assert 'machinerry_run_failures_total{machine="%s"} 1' % name in lines
+            assert ('machinerry_run_duration_seconds_bucket{machine="%s",le="+Inf"} 2'
+                    % name) in lines
+            assert 'machinerry_state{machine="%s",state="PAUSED"} 1' % name in lines
+            assert 'machinerry_pauses_total{machine="%s"} 1' % name in lines
+        finally:
+            self.machine.unsubscribe()
+        assert self.machine not in registered_machines()
+
+    def test_machine_status_snapshot(self):
+        self.machine.wait_run_frequency = 10
+        self.machine.start()
+        self.wait(0.3)
+
+        # The status is taken from a single snapshot of the machine.
+        snapshot = self.machine.machine_snapshot
+        status = self.machine.status()
+        self.assertEqual(status['generation'], snapshot.generation)
+        self.assertEqual(status['state'], snapshot.state)
+        self.assertEqual(status['times']['next'], snapshot.time_next)
+
+        # While nothing happens, the snapshot doesn't change.
+        self.wait(0.3)
+        assert self.machine.machine_snapshot is snapshot
+
+        # But it's replaced as soon as something does.
+        self.machine.run_now()
+        self.wait(0.3)
+        assert self.machine.machine_snapshot.generation > snapshot.generation
+        assert self.machine.machine_snapshot.time_start > snapshot.time_start
+
+    def test_machine_wait_for_state_and_run(self):
+        self.machine.wait_run_frequency = 10
+        assert not self.machine.wait_for_state('WAITING', timeout=0.1)
+
+        self.machine.start()
+        assert self.machine.wait_for_state(['WAITING', 'PAUSED'], timeout=2)
+        first = self.machine.machine_last_run
+        self.assertEqual(first.id, 0)
+
+        # No run is due for a while, so this should time out.
+        self.assertEqual(self.machine.wait_for_run(timeout=0.1), None)
+
+        self.machine.echo('Hitsugaya')
+        self.machine.run_now()
+        run = self.machine.wait_for_run(first.id, timeout=2)
+        self.assertEqual(run.id, 1)
+        self.assertPrinted('Hitsugaya')
+
+        self.machine.stop()
+        assert self.machine.wait_for_state('STOPPED', timeout=2)
+
+    def test_machine_observers(self):
+        events = Queue(maxsize=2)
+        slow_events = []
+
+        def slow_observer(event):
+            time.sleep(0.2)
+            slow_events.append(event.kind)
+
+        self.machine.add_observer(events)
+        self.machine.add_observer(slow_observer, kinds=['error', 'pause'])
+
+        # Slow observers shouldn't hold up the machine.
+        started = time.time()
+        self.machine.fail('Kido')
+        for i in range(4):
+            self.machine.run_once()
+        self.machine.paused = True
+        self.machine._become_paused(True)
+        assert time.time() - started < 0.2
+
+        # The queue only has room for the most recent events.
+        self.wait(0.6)
+        kinds = [events.get_nowait().kind, events.get_nowait().kind]
+        self.assertEqual(kinds, ['run', 'pause'])
+        self.assertEqual(slow_events, ['error', 'pause'])
+
+        self.machine.remove_observer(events)
+        self.machine.run_once()
+        self.wait(0.1)
+        assert events.empty()
+
+    def test_machine_observer_kinds(self):
+        runs = Queue()
+        self.machine.add_observer(runs, kinds='run')
+        with pytest.raises(ValueError):
+            self.machine.add_observer(runs, kinds=['run', 'bankai'])
+
+        # An observer blocked on a full queue doesn't hold up the others.
+        stuck = Queue(maxsize=1)
+        self.machine.add_observer(stuck, overflow='block')
+        for i in range(3):
+            self.machine.run_once()
+        self.wait(0.2)
+        self.assertEqual([runs.get_nowait().kind for i in range(3)],
+                         ['run'] * 3)
+        assert runs.empty()
+        assert stuck.full()
+
+        # Events for it are held on to until there is room.
+        self.assertEqual(self.machine.status()['observers']['pending'], 2)
+        self.machine.remove_observer(stuck)
+        for i in range(3):
+            stuck.get(timeout=1)
+
+    def test_machine_observers_share_threads(self):
+        machines = [MachineForTesting('observed_%d' % i) for i in range(20)]
+        events = Queue()
+        for m in machines:
+            m.add_observer(events)
+            m.run_once()
+        for m in machines:
+            events.get(timeout=1)
+        threads = [t for t in threading.enumerate()
+                   if t.name == 'machinerry observer']
+        assert len(threads) <= 4
+
+        # Observers can be added while a run holds the machine's lock.
+        with machines[0]._machine_lock:
+            thread = threading.Thread(
+                target=machines[0].add_observer, args=(events,))
+            thread.start()
+            thread.join(1)
+            assert not thread.is_alive()
+
+        # Events which had to be discarded are reported.
+        stuck = Queue(maxsize=1)
+        stuck.put(None)
+        machine = MachineForTesting('observed_stuck')
+        machine.add_observer(stuck, overflow='block')
+        for i in range(1003):
+            machine._emit_event('run')
+        status = machine.status()['observers']
+        self.assertEqual((status['pending'], status['dropped']), (1000, 3))
+        machine.remove_observer(stuck)
+
+    def test_machine_queued_logging(self):
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                time.sleep(0.2)
+
+        slow = SlowHandler()
+        cherrypy.log.error_log.addHandler(slow)
+        enable_queued_logging()
+        try:
+            # Logging shouldn't wait for the slow handler.
+            started = time.time()
+            self.machine.pause_for_reason(self.admin, 'Hado')
+            self.machine.resume_by(self.admin2)
+            assert time.time() - started < 0.2
+        finally:
+            disable_queued_logging()
+            cherrypy.log.error_log.removeHandler(slow)
+
+        # Disabling it should have made sure everything got written.
+        self.assertPrinted('%s set to pause by admin - Hado' %
+                           self.machine.machine_name)
+        self.assertPrinted('%s set to resume by admin2.' %
+                           self.machine.machine_name)
+
+    def test_machine_status_notifier(self, tmp_path):
+        sink = str(tmp_path / 'alerts.txt')
+        notifier = StatusNotifier(FileTransport(sink), window=0.3, retry_delay=0)
+
+        # Alerts from several machines get combined, and only the latest
+        # one from each machine is kept.
+        other = MachineForTesting('notifier_other')
+        for m in (self.machine, other):
+            m.status_notifier = notifier
+        self.machine.pause_for_reason(self.admin, 'Because I wanted to!')
+        self.machine.paused = True
+        self.machine._become_paused(True)
+        self.machine.notify_status_via_email()
+        self.machine.notify_status_via_email('Reminder')
+        other.notify_status_via_email()
+        self.wait(0.6)
+
+        with open(sink) as f:
+            text = f.read()
+        assert text.startswith('Subject: Status of 2 machines')
+        assert 'Paused by: admin' in text
+        assert 'Reason: Because I wanted to!' in text
+        assert '(latest of 2 alerts)' in text
+        assert 'Reminder' in text
+
+        # Failed deliveries get retried.
+        attempts = []
+
+        class FlakyTransport(object):
+            def send(self, subject, body):
+                attempts.append(subject)
+                if len(attempts) == 1:
+                    raise IOError('connection refused')
+
+        notifier.transport = FlakyTransport()
+        other.notify_status_via_email()
+        notifier.flush(timeout=2)
+        self.assertEqual(attempts, ['notifier_other STOPPED'] * 2)
+
+    def test_stop_machines_together(self):
+        machines = [MachineForTesting('shutdown_%d' % i) for i in range(3)]
+        for m in machines:
+            m.delay(1)
+            m.start()
+        self.wait(0.2)
+
+        # Machines which can't finish in time are reported.
+        started = time.time()
+        self.assertEqual(stop_machines(machines, timeout=0.2), machines)
+        assert time.time() - started < 0.4
+
+        # Otherwise, all the machines are waited for at the same time.
+        machines = [MachineForTesting('shutdown_%d' % i) for i in range(3)]
+        for m in machines:
+            m.delay(1)
+            m.start()
+        self.wait(0.2)
+        started = time.time()
+        self.assertEqual(stop_machines(machines, timeout=5), [])
+        assert time.time() - started < 1.5
+        for m in machines:
+            self.assertEqual(m.machine_state, 'STOPPED')
+
+    def test_run_machines_standalone(self):
+        machines = [MachineForTesting('standalone_%d' % i) for i in range(2)]
+        for m in machines:
+            m.delay(0.5)
+        previous = signal.getsignal(signal.SIGTERM)
+
+        # Machines run until we get a signal, and are then stopped.
+        timer = threading.Timer(
+            0.2, os.kill, args=(os.getpid(), signal.SIGTERM))
+        timer.start()
+        self.assertEqual(run_machines(machines, timeout=5), [])
+        for m in machines:
+            self.assertEqual(m.machine_state, 'STOPPED')
+            self.assertEqual(m.status()['stats']['count'], 1)
+            assert m not in registered_machines()
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous)
+
+    def test_import_without_cherrypy(self):
+        code = ("import sys, machinerry; "
+                "assert 'cherrypy' not in sys.modules")
+        subprocess.check_call([sys.executable, '-c', code])
+
+    def test_errors_logged_without_cherrypy(self):
+        # Tracebacks go to the machinerry logger as errors, so that they
+        # are shown even if logging hasn't been configured.
+        if not hasattr(logging, 'lastResort'):
+            pytest.skip('Python 2 drops unhandled log messages')
+        code = ("import machinerry\n"
+                "try:\n"
+                "    1 / 0\n"
+                "except ZeroDivisionError:\n"
+                "    machinerry._log('oops', traceback=True)\n")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], stderr=subprocess.STDOUT)
+        assert b'oops' in output and b'ZeroDivisionError' in output
+
+    def test_machine_run_cancellation(self):
+        self.machine.run_history_limit = 0
+        self.machine.snooze(10)
+        self.machine.start()
+        self.wait(0.2)
+
+        # Pausing the machine should cut the run short.
+        self.machine.paused = True
+        self.wait(0.2)
+        self.assertState('PAUSED')
+        run = self.runs[0]
+        assert run.cancelled and not run.failed
+        self.assertEqual(run.token.reason, 'pause')
+
+        # As should stopping it.
+        self.machine.paused = False
+        self.machine.snooze(10)
+        self.wait(0.5)
+        self.machine.stop()
+        self.wait(0.2)
+        self.assertState('STOPPED')
+        self.assertEqual(self.runs[-1].token.reason, 'stop')
+
+    def test_machine_run_timeout(self):
+        self.machine.run_history_limit = 0
+        self.machine.run_timeout = 0.2
+        self.machine.snooze(10)
+        started = time.time()
+        self.machine.run_once()
+        assert time.time() - started < 0.5
+        assert self.runs[-1].cancelled
+        self.assertEqual(self.runs[-1].token.reason, 'timeout')
+
+        # Runs which finish in time aren't cancelled.
+        self.machine.run_once()
+        assert not self.runs[-1].cancelled
+
+        # Nor does the watchdog hang on to them.
+        self.machine.run_timeout = 3600
+        for i in range(100):
+            self.machine.run_once()
+        heap = machinerry._watchdog._heap
+        assert len(heap) < 100
+        assert not [i for i in heap if i[2] is self.machine]
+
+    def test_machine_run_overrun(self):
+        self.machine.run_history_limit = 0
+        self.machine.run_timeout = 0.3
+        self.machine.pause_on_overrun = True
+        self.machine.delay(1)
+        self.machine.start()
+
+        # While the run is still in progress, it should be flagged as
+        # having overrun, and we should know where it was stuck.
+        self.wait(0.6)
+        run = self.runs[0]
+        assert run.overrun
+        assert 'perform_delay' in run.overrun_stack
+        self.assertPrinted('%s run 0 has taken longer than 0.3 seconds'
+                           % self.machine.machine_name)
+        assert self.machine.paused
+
+        # Once it finishes, the machine pauses. The run ignored its token
+        # and finished normally, so it doesn't count as being cancelled.
+        self.wait(0.6)
+        self.assertState('PAUSED')
+        assert run.overrun and not run.cancelled and not run.failed
+
+    def test_queue_machine(self):
+        machine = QueueMachineForTesting('queue_machine')
+        machine.batch_size = 100
+        for i in range(250):
+            machine.put(i)
+        machine.start()
+        try:
+            # Everything already queued gets taken in batches.
+            self.wait(0.2)
+            self.assertEqual([len(b) for b in machine.batches], [100, 100, 50])
+            self.assertEqual(machine.status()['queue'], 0)
+
+            # New items get processed straight away - not after wait_min.
+            machine.put('Ichigo')
+            self.wait(0.1)
+            self.assertEqual(machine.batches[-1], ['Ichigo'])
+            assert machine.status()['lag']['start']['last'] >= 0
+
+            # Failures still back off by wait_on_error.
+            machine.wait_on_error = 10
+            machine.put('fail')
+            self.wait(0.1)
+            machine.put('Rukia')
+            self.wait(0.1)
+            self.assertEqual(machine.batches[-1], ['Ichigo'])
+            self.assertEqual(machine.status()['queue'], 1)
+        finally:
+            machine.stop()
+
+    def test_queue_machine_batch_wait(self):
+        machine = QueueMachineForTesting('queue_batch_wait')
+        machine.batch_size = 3
+        machine.batch_wait = 0.5
+        machine.start()
+        try:
+            # The batch is sent once it is full, without waiting for the
+            # rest of batch_wait.
+            machine.put('Ichigo')
+            self.wait(0.1)
+            machine.put('Rukia')
+            machine.put('Renji')
+            self.wait(0.1)
+            self.assertEqual(machine.batches, [['Ichigo', 'Rukia', 'Renji']])
+
+            # Otherwise, it is sent when batch_wait has passed.
+            machine.put('Orihime')
+            self.wait(0.2)
+            self.assertEqual(len(machine.batches), 1)
+            self.wait(0.5)
+            self.assertEqual(machine.batches[-1], ['Orihime'])
+        finally:
+            machine.stop()
+
+    def test_backpressure_hysteresis(self):
+        levels = [0, 5, 10, 7, 9, 5, 9, 10]
+        bp = Backpressure(lambda: levels.pop(0), high=10, low=5)
+        engaged = [bp.update() for i in range(8)]
+        self.assertEqual(engaged, [False, False, True, True, True, False,
+                                   False, True])
+        self.assertEqual(bp.transitions, 3)
+        with pytest.raises(ValueError):
+            Backpressure(levels, high=5, low=10)
+
+    def test_machine_backpressure(self):
+        sink = Queue()
+        self.machine.backpressure = Backpressure(sink, high=3, low=1)
+        self.machine.start()
+        self.wait(0.1)
+        self.assertState('WAITING')
+
+        # Reaching the high watermark pauses the machine...
+        for i in range(3):
+            sink.put(i)
+        self.wait(0.2)
+        self.assertState('PAUSED')
+        status = self.machine.status()['backpressure']
+        assert status['engaged']
+        self.assertEqual(status['level'], 3)
+
+        # ... and it stays paused until we get down to the low watermark.
+        sink.get()
+        self.wait(0.2)
+        self.assertState('PAUSED')
+        sink.get()
+        self.wait(0.2)
+        self.assertState('WAITING')
+        self.assertEqual(self.machine.status()['backpressure']['transitions'], 2)
+
+        # It won't resume a machine which has been paused for another
+        # reason in the meantime.
+        for i in range(2):
+            sink.put(i)
+        self.wait(0.2)
+        self.machine.pause_for_reason(None, 'Hollows sighted')
+        for i in range(3):
+            sink.get()
+        self.wait(0.2)
+        self.assertState('PAUSED')
+        self.assertEqual(self.machine.pause_reason, 'Hollows sighted')
+
+    def test_queue_machine_throttles_producers(self):
+        class ThrottledMachine(QueueMachineForTesting):
+            queue_high = 3
+            queue_low = 1
+
+        machine = ThrottledMachine('queue_throttled')
+        for i in range(3):
+            machine.put_nowait(i)
+        with pytest.raises(Full):
+            machine.put_nowait(3)
+        with pytest.raises(Full):
+            machine.put(3, timeout=0.1)
+        assert machine.status()['queue_backpressure']['engaged']
+
+        # Once the machine drains the queue, producers can carry on.
+        machine.start()
+        try:
+            machine.put(3, timeout=1)
+            self.wait(0.1)
+            self.assertEqual(machine.batches, [[0, 1, 2], [3]])
+        finally:
+            machine.stop()
+
+    def test_priority_queue_machine(self):
+        machine = PriorityQueueMachineForTesting('queue_priority')
+        machine.batch_size = 3
+        for i in range(4):
+            machine.put('backfill_%d' % i, priority=5)
+        machine.put('later', priority=0, deadline=20)
+        machine.put_nowait('sooner', priority=0, deadline=10)
+        machine.put('whenever', True, None, priority=0)
+        machine.put('expired', priority=0, deadline=0.05)
+        with pytest.raises(TypeError):
+            machine.put('typo', priorty=0)
+
+        status = machine.status()['priorities']
+        self.assertEqual(status[0]['depth'], 4)
+        self.assertEqual(status[5]['depth'], 4)
+        self.wait(0.1)
+
+        # Urgent jobs come first (by deadline), and expired jobs are
+        # passed on rather than processed.
+        machine.start()
+        try:
+            self.wait(0.2)
+            self.assertEqual(machine.batches, [
+                ['sooner', 'later', 'whenever'],
+                ['backfill_0', 'backfill_1', 'backfill_2'],
+                ['backfill_3'],
+            ])
+            self.assertEqual(machine.expired, ['expired'])
+
+            status = machine.status()['priorities']
+            self.assertEqual(status[0]['depth'], 0)
+            self.assertEqual(status[0]['expired'], 1)
+            self.assertEqual(status[0]['wait']['count'], 3)
+            self.assertEqual(status[5]['wait']['count'], 4)
+            assert status[5]['wait']['max'] >= 0.1
+        finally:
+            machine.stop()
+
+    def check_file_watch_machine(self, use_inotify):
+        path = tempfile.mkdtemp()
+        machine = FileWatchMachineForTesting('file_watch', path)
+        machine.watch_inotify = use_inotify
+        machine.watch_interval = 0.05
+
+        def write(name, content):
+            with open(os.path.join(path, name), 'w') as f:
+                f.write(content)
+
+        write('ichigo', 'Zangetsu')
+        write('rukia', 'Sode no Shirayuki')
+        machine.start()
+        try:
+            # The files which are already there get passed to the first
+            # run.
+            self.wait(0.3)
+            self.assertEqual(machine.changes, [['ichigo', 'rukia']])
+            mode = machine.status()['watch']['mode']
+            self.assertEqual(mode, 'inotify' if use_inotify else 'scan')
+
+            # After that, we're only told about what changes.
+            write('renji', 'Zabimaru')
+            self.wait(0.3)
+            self.assertEqual(machine.changes[-1], ['renji'])
+            write('ichigo', 'Tensa Zangetsu')
+            os.remove(os.path.join(path, 'rukia'))
+            self.wait(0.3)
+            self.assertEqual(machine.changes[-1], ['ichigo', 'rukia'])
+
+            # Nothing changing means no runs - and changes to directories
+            # don't count.
+            runs = len(machine.changes)
+            os.mkdir(os.path.join(path, 'soul_society'))
+            os.rename(os.path.join(path, 'soul_society'),
+                      os.path.join(path, 'seireitei'))
+            os.rmdir(os.path.join(path, 'seireitei'))
+            self.wait(0.3)
+            self.assertEqual(len(machine.changes), runs)
+        finally:
+            machine.stop()
+            shutil.rmtree(path)
+
+    def test_file_watch_machine_scanning(self):
+        self.check_file_watch_machine(use_inotify=False)
+
+    def test_file_watch_machine_inotify(self):
+        if not sys.platform.startswith('linux'):
+            pytest.skip('inotify is only available on Linux')
+        self.check_file_watch_machine(use_inotify=True)
+
+    def test_file_watch_machine_without_path(self):
+        # Rather than watching the current directory, the machine fails.
+        machine = FileWatchMachineForTesting('file_watch_nowhere', None)
+        with pytest.raises(ValueError):
+            machine.run()
+        self.assertEqual(machine.machine_state, 'FAILED')
+        self.assertEqual(machine.changes, [])
+
+    def test_partitioned_machine(self):
+        machine = PartitionedMachine('partitioned', QueueMachineForTesting, 3)
+        names = [m.machine_name for m in machine.partitions]
+        self.assertEqual(names, ['partitioned[0]', 'partitioned[1]',
+                                 'partitioned[2]'])
+
+        # Keys always go to the same partition, and are spread out.
+        keys = ['tenant_%d' % i for i in range(30)]
+        indexes = [machine.partition_index(key) for key in keys]
+        self.assertEqual(indexes, [machine.partition_index(k) for k in keys])
+        self.assertEqual(set(indexes), set([0, 1, 2]))
+        self.assertEqual(
+            sorted(sum([machine.keys_for(i, keys) for i in range(3)], [])),
+            sorted(keys))
+
+        # Text keys are partitioned by their UTF-8 encoding.
+        self.assertEqual(machine.partition_index(u'caf\xe9'),
+                         machine.partition_index(b'caf\xc3\xa9'))
+        self.assertEqual(machine.partition_index(7),
+                         machine.partition_index('7'))
+
+        machine.start()
+        try:
+            # A paused partition doesn't hold up the others.
+            slow = machine.partition_index('tenant_0')
+            machine.pause_for_reason(None, 'Menos Grande', index=slow)
+            self.wait(0.1)
+            for key in keys:
+                machine.put(key, key)
+            self.wait(0.2)
+
+            for index, partition in enumerate(machine.partitions):
+                taken = sum(partition.batches, [])
+                if index == slow:
+                    self.assertEqual(taken, [])
+                else:
+                    self.assertEqual(taken, machine.keys_for(index, keys))
+
+            status = machine.status()
+            self.assertEqual(status['states'], {'PAUSED': 1, 'WAITING': 2})
+            self.assertEqual(status['paused'], [slow])
+            self.assertEqual(len(status['partitions']), 3)
+            self.assertEqual(status['stats']['count'],
+                             sum(m.machine_stats.count
+                                 for m in machine.partitions))
+
+            # Once resumed, it catches up.
+            machine.resume_by(None, index=slow)
+            self.wait(0.2)
+            self.assertEqual(sum(machine.partitions[slow].batches, []),
+                             machine.keys_for(slow, keys))
+        finally:
+            machine.stop()
+
+    def test_sqlite_lease(self):
+        path = tempfile.mkdtemp()
+        db = os.path.join(path, 'leases.db')
+        ichigo = SQLiteLease(db, ttl=0.3)
+        rukia = SQLiteLease(db, ttl=0.3)
+        try:
+            assert ichigo.acquire('shinigami')
+            assert not rukia.acquire('shinigami')
+            assert rukia.acquire('kido')
+
+            # Renewing keeps hold of it, but once it expires, someone
+            # else can take it over.
+            self.wait(0.2)
+            assert ichigo.acquire('shinigami')
+            self.wait(0.2)
+            assert not rukia.acquire('shinigami')
+            self.wait(0.2)
+            assert rukia.acquire('shinigami')
+            assert not ichigo.acquire('shinigami')
+
+            # Releasing it allows it to be taken straight away.
+            rukia.release('shinigami')
+            assert ichigo.acquire('shinigami')
+        finally:
+            ichigo.close()
+            rukia.close()
+            shutil.rmtree(path)
+
+    def test_file_lease(self):
+        pytest.importorskip('fcntl')
+        path = tempfile.mkdtemp()
+        ichigo = FileLease(path)
+        rukia = FileLease(path)
+        try:
+            assert ichigo.acquire('shinigami')
+            assert ichigo.acquire('shinigami')
+            assert not rukia.acquire('shinigami')
+            ichigo.release('shinigami')
+            assert rukia.acquire('shinigami')
+            assert not ichigo.acquire('shinigami')
+
+            # Closing the lease gives up everything it holds.
+            rukia.close()
+            assert ichigo.acquire('shinigami')
+        finally:
+            ichigo.close()
+            rukia.close()
+            shutil.rmtree(path)
+
+    def test_machine_lease(self):
+        path = tempfile.mkdtemp()
+        db = os.path.join(path, 'leases.db')
+        machines = [MachineForTesting('leased') for i in range(2)]
+        for m in machines:
+            m.lease = SQLiteLease(db, ttl=0.6)
+            m.wait_run_frequency = 10
+            m.start()
+        try:
+            # Only one of them gets to run - the other waits on standby.
+            self.wait(0.3)
+            states = sorted(m.machine_state for m in machines)
+            self.assertEqual(states, ['STANDBY', 'WAITING'])
+            leader, standby = sorted(
+                machines, key=lambda m: m.machine_state == 'STANDBY')
+            assert leader.status()['lease']['held']
+            assert not standby.status()['lease']['held']
+            assert not standby.status()['active']
+            self.assertEqual(standby.status()['stats']['count'], 0)
+
+            # When the leader stops, the other one takes over.
+            leader.stop()
+            self.wait(0.4)
+            self.assertEqual(standby.machine_state, 'WAITING')
+            assert standby.status()['lease']['held']
+            self.assertEqual(standby.status()['stats']['count'], 1)
+        finally:
+            for m in machines:
+                m.stop()
+            self.wait(0.1)
+            for m in machines:
+                m.lease.close()
+            shutil.rmtree(path)
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+
+from machinerry import Machine
+from machinerry_async import AsyncMachine
+
+
+class AsyncMachineForTesting(AsyncMachine):
+
+    def __init__(self, name):
+        AsyncMachine.__init__(self, name)
+        self.jobs = []
+        self.message_log = []
+
+    def on_machine_error(self, exception):
+        self.message_log.append('error: %s' % exception)
+
+    async def execute(self):
+        if not self.jobs:
+            return
+        action, arg = self.jobs.pop(0)
+        if action == 'delay':
+            await asyncio.sleep(arg)
+        elif action == 'echo':
+            self.message_log.append(arg)
+        elif action == 'fail':
+            raise RuntimeError(arg)
+
+
+class ThreadedMachineForTesting(Machine):
+
+    def execute(self):
+        pass
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsyncMachine(object):
+
+    def test_machine_async_basics(self):
+
+        async def scenario():
+            machine = AsyncMachineForTesting('async_basics')
+            machine.wait_run_frequency = 10
+            machine.jobs.append(('echo', 'Ichigo'))
+            machine.start()
+            await asyncio.sleep(0.2)
+            assert machine.machine_state == 'WAITING'
+            assert machine.message_log == ['Ichigo']
+
+            # run_now should wake it up well before its next run.
+            machine.jobs.append(('echo', 'Rukia'))
+            machine.run_now()
+            await asyncio.sleep(0.2)
+            assert machine.message_log == ['Ichigo', 'Rukia']
+
+            # Pausing and resuming should behave as it does on a thread -
+            # including when requested from another thread.
+            t = threading.Thread(target=setattr, args=(machine, 'paused', True))
+            t.start()
+            t.join()
+            await asyncio.sleep(0.2)
+            assert machine.machine_state == 'PAUSED'
+            machine.paused = False
+            await asyncio.sleep(0.2)
+            assert machine.machine_state == 'WAITING'
+
+            # Errors are handled in the same way too.
+            machine.wait_on_error = 10
+            machine.jobs.append(('fail', 'Bankai!'))
+            machine.run_now()
+            await asyncio.sleep(0.2)
+            assert machine.message_log[-1] == 'error: Bankai!'
+            assert (machine.run_time_next - machine.run_time_end).seconds == 10
+
+            machine.stop()
+            await asyncio.sleep(0.1)
+            assert machine.machine_state == 'STOPPED'
+
+        run_async(scenario())
+
+    def test_machine_wait_for_state_async(self):
+
+        async def scenario():
+            # A machine running in its own thread can be waited on from
+            # an event loop.
+            machine = ThreadedMachineForTesting('async_wait')
+            machine.wait_run_frequency = 10
+            try:
+                assert not await machine.wait_for_state_async('WAITING', 0.1)
+                machine.start()
+                assert await machine.wait_for_state_async('WAITING', 2)
+                machine.run_now()
+                run = await machine.wait_for_run_async(0, timeout=2)
+                assert run.id == 1
+            finally:
+                machine.stop()
+
+        run_async(scenario())
+
+    def test_machine_async_shares_one_thread(self):
+
+        async def scenario():
+            threads_before = threading.active_count()
+            machines = [AsyncMachineForTesting('async_%d' % i)
+                        for i in range(50)]
+            for m in machines:
+                m.jobs.append(('delay', 0.5))
+                m.start()
+
+            # Each machine's run should be in progress concurrently, with
+            # no threads being created for them.
+            await asyncio.sleep(0.2)
+            assert threading.active_count() == threads_before
+            assert all(m.machine_state == 'RUNNING' for m in machines)
+
+            await asyncio.sleep(0.5)
+            assert all(m.machine_state == 'WAITING' for m in machines)
+
+            for m in machines:
+                m.stop()
+            await asyncio.sleep(0.1)
+            assert all(m.machine_state == 'STOPPED' for m in machines)
+
+        run_async(scenario())